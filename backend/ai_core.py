@@ -5,6 +5,7 @@ This version uses the modern google-genai Client pattern.
 import os
 import json
 import asyncio
+import time
 
 from google import genai
 from google.genai import types
@@ -14,107 +15,260 @@ import google.auth.credentials
 import google.oauth2.service_account
 
 # Import persona configurations
+from . import answer_pack
 from . import config
+from . import context_builder
+from . import executor
+from . import live_pool
+from . import metrics
+from . import pronunciation
+from . import singleflight
+from . import subsystems
+from . import tts_cache
 
 # --- Configuration ---
 API_KEY = os.environ.get("GEMINI_API_KEY")
 GOOGLE_APPLICATION_CREDENTIALS_JSON = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON")
 
 client = None
-tts_client = None
+tts_credentials = None
+tts_enabled = False
 
 if GOOGLE_APPLICATION_CREDENTIALS_JSON:
     info = json.loads(GOOGLE_APPLICATION_CREDENTIALS_JSON)
     credentials = google.oauth2.service_account.Credentials.from_service_account_info(info)
     client = genai.Client(credentials=credentials)
-    tts_client = texttospeech.TextToSpeechClient(credentials=credentials)
+    tts_credentials = credentials
+    tts_enabled = True
 elif API_KEY:
     client = genai.Client(api_key=API_KEY)
-    # This client uses standard Google Cloud authentication (not the API key)
-    tts_client = texttospeech.TextToSpeechClient()
+    # The TTS client uses standard Google Cloud authentication (not the API key)
+    tts_enabled = True
 
-# --- Knowledge Base (CUSTOMIZE THIS) ---
-def search_knowledge_base(query: str) -> list:
-    """Placeholder for a real knowledge base search (e.g., Elasticsearch)."""
+_tts_client = None
+
+def get_tts_client():
+    """Returns the async Text-to-Speech client, created lazily inside the running event loop."""
+    global _tts_client
+    if not tts_enabled:
+        return None
+    if _tts_client is None:
+        if tts_credentials is not None:
+            _tts_client = texttospeech.TextToSpeechAsyncClient(credentials=tts_credentials)
+        else:
+            _tts_client = texttospeech.TextToSpeechAsyncClient()
+    return _tts_client
+
+# --- Knowledge Base ---
+async def search_knowledge_base(query: str) -> list:
+    """Retrieves the passages most relevant to the query (see retrieval.py)."""
     print(f"Searching knowledge base for: {query}")
-    return [
-        "Manatees are large, fully aquatic, mostly herbivorous marine mammals. Their diet consists of seagrasses and other aquatic vegetation.",
-        "The San San Pond Sak wetlands are a Ramsar site of international importance, located in the Bocas del Toro province of Panama.",
-        "Local folklore speaks of the 'tulivieja', a spirit that protects the rivers and is said to appear as a woman with a monstrous face.",
-        "The red mangrove, or 'Mangle Rojo', has distinctive prop roots that help stabilize coastlines and provide critical nursery habitat for fish and invertebrates."
-    ]
+    retrieval = await subsystems.aload("retrieval")
+    with metrics.span("retrieval"):
+        passages = await retrieval.get_retriever().asearch(query)
+    return [passage.text for passage in passages]
 
 # --- Core AI Functions ---
-def generate_text_response(query: str, context: list) -> str:
-    print("Generating text response (Papito)...")
-    context_str = "\n".join(context)
-    full_prompt = f"Context:\n---\n{context_str}\n---\n\nQuestion: {query}"
-    
-    response = client.models.generate_content(
-        model=config.TEXT_MODEL_NAME.replace("models/", ""),
-        contents=full_prompt,
-        config=GenerateContentConfig(
-            system_instruction=config.TEXT_PERSONA_PROMPT
-        ),
-    )
-    return response.text
+def _text_request(query: str, context: list) -> dict:
+    model = config.TEXT_MODEL_NAME.replace("models/", "")
+    # The persona prompt is static; keep it in Gemini's context cache where the model allows
+    cached_content = context_builder.system_cache.get(client, model, config.TEXT_PERSONA_PROMPT)
+    with metrics.span("prompt_build"):
+        built = context_builder.build(query, context, "papito")
+        full_prompt = built.prompt(query)
+    context_builder.log_prompt_size(built, config.TEXT_PERSONA_PROMPT, query, cached_system=cached_content is not None)
+    if cached_content:
+        generation_config = GenerateContentConfig(cached_content=cached_content)
+    else:
+        generation_config = GenerateContentConfig(system_instruction=config.TEXT_PERSONA_PROMPT)
+    return dict(model=model, contents=full_prompt, config=generation_config)
+
+# Identical questions in flight at the same time share one upstream call
+text_flights = singleflight.SingleFlight("papito_text")
+audio_flights = singleflight.SingleFlight("mateo_audio")
+speech_flights = singleflight.SingleFlight("papito_speech")
+
+async def generate_text_response(query: str, context: list) -> str:
+    async def generate():
+        print("Generating text response (Papito)...")
+        with metrics.span("gemini_text_total"):
+            response = await client.aio.models.generate_content(**_text_request(query, context))
+        return response.text
+
+    return await text_flights.do(singleflight.make_key(query, *context), generate)
 
-def synthesize_papito_speech(text: str) -> bytes:
+async def stream_text_response(query: str, context: list):
+    """Yields Papito's answer incrementally as Gemini produces it."""
+    async def generate():
+        print("Streaming text response (Papito)...")
+        start = time.perf_counter()
+        first_token = True
+        stream = await client.aio.models.generate_content_stream(**_text_request(query, context))
+        async for chunk in stream:
+            if chunk.text:
+                if first_token:
+                    metrics.observe("gemini_text_first_token", time.perf_counter() - start)
+                    first_token = False
+                yield chunk.text
+        metrics.observe("gemini_text_total", time.perf_counter() - start)
+
+    async for delta in text_flights.stream(singleflight.make_key(query, *context), generate):
+        yield delta
+
+def build_papito_ssml(text: str) -> str:
+    """Wraps Papito's text in SSML, applying the pronunciation dictionary."""
+    return pronunciation.engine.to_ssml(text)
+
+# Papito's read-aloud voice; these are part of the TTS cache key
+PAPITO_LANGUAGE_CODE = "en-US"
+PAPITO_VOICE_NAME = "en-US-Standard-D"
+PAPITO_AUDIO_ENCODING = texttospeech.AudioEncoding.MP3
+
+async def synthesize_papito_speech(text: str) -> bytes:
     """Synthesizes speech for Papito's text using a standard voice."""
-    if not tts_client:
-        raise ConnectionError("Text-to-Speech client not initialized.")
+    _, audio = await get_papito_speech(text)
+    return audio
 
-    # Load pronunciation dictionary
-    pronunciation_file = os.path.join(os.path.dirname(__file__), "pronunciations.json")
-    with open(pronunciation_file, 'r') as f:
-        pronunciations = json.load(f)
+async def get_papito_speech(text: str) -> tuple:
+    """Returns (cache key, MP3 bytes) for Papito's text, synthesizing only on a cache miss."""
+    # A (re)load reads the JSON and compiles the matcher, so it stays off the event loop
+    ssml_text = await executor.run("default", build_papito_ssml, text)
+    key = tts_cache.make_key(ssml_text, PAPITO_VOICE_NAME, PAPITO_AUDIO_ENCODING.name)
 
-    # Apply SSML for pronunciations
-    for word, pronunciation in pronunciations.items():
-        text = text.replace(word, f'<phoneme alphabet="x-ipa" ph="{pronunciation}">{word}</phoneme>')
+    audio = answer_pack.speech(key)
+    if audio is not None:
+        return key, audio
+
+    async def lookup_or_synthesize():
+        cached = await tts_cache.cache.get(key)
+        if cached is not None:
+            return cached
+        synthesized = await _synthesize_ssml(ssml_text)
+        await tts_cache.cache.put(key, synthesized)
+        return synthesized
+
+    # Concurrent requests for the same text share one synthesis
+    return key, await speech_flights.do(key, lookup_or_synthesize)
+
+async def _synthesize_ssml(ssml_text: str) -> bytes:
+    tts_client = get_tts_client()
+    if not tts_client:
+        raise ConnectionError("Text-to-Speech client not initialized.")
 
-    ssml_text = f"<speak>{text}</speak>"
-    
     synthesis_input = texttospeech.SynthesisInput(ssml=ssml_text)
-    voice = texttospeech.VoiceSelectionParams(language_code="en-US", name="en-US-Standard-D")
-    audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
+    voice = texttospeech.VoiceSelectionParams(language_code=PAPITO_LANGUAGE_CODE, name=PAPITO_VOICE_NAME)
+    audio_config = texttospeech.AudioConfig(audio_encoding=PAPITO_AUDIO_ENCODING)
     
-    response = tts_client.synthesize_speech(
-        input=synthesis_input, voice=voice, audio_config=audio_config
-    )
+    with metrics.span("tts_synthesis"):
+        response = await tts_client.synthesize_speech(
+            input=synthesis_input, voice=voice, audio_config=audio_config
+        )
     return response.audio_content
 
 
 # --- Live API Session Class for Papito ---
+def _connect_live():
+    return client.aio.live.connect(
+        model=config.AUDIO_MODEL_NAME,
+        # Mateo's persona is set once per session, not repeated in every turn
+        config=types.LiveConnectConfig(response_modalities=["AUDIO"], system_instruction=config.AUDIO_PERSONA_PROMPT)
+    )
+
+# Pre-connected Live sessions; started with the app when a Gemini client is configured
+live_sessions = live_pool.LiveSessionPool(_connect_live)
+
 class MateoAudioSession:
+    """Mateo's side of one visitor conversation; keeps a Live session across turns."""
+
     def __init__(self, client_websocket):
         self.client_websocket = client_websocket
+        self.live = None
+        self.closed = False
+        self._turn_lock = asyncio.Lock()
+        self._producer = None  # Task running the latest turn on `self.live`
+
+    async def _lease(self) -> tuple:
+        """Returns (session, reused), replacing the conversation's session if it went stale."""
+        if self.live is not None and not self.live.healthy(live_sessions.max_age):
+            await live_sessions.discard(self.live)
+            self.live = None
+        if self.live is not None:
+            return self.live, True
+        self.live = await live_sessions.acquire()
+        return self.live, False
 
-    async def generate_and_stream_audio(self, query: str, context: list):
+    async def _live_audio(self, query: str, context: list):
+        """Yields Mateo's raw PCM chunks from the conversation's Gemini Live session."""
         print("Generating audio response (Mateo)...")
+        with metrics.span("prompt_build"):
+            built = context_builder.build(query, context, "mateo")
+            prompt = built.prompt(query)
+        context_builder.log_prompt_size(built, config.AUDIO_PERSONA_PROMPT, query, cached_system=True)
 
-        # Combine prompts
-        system_prompt = f"{config.AUDIO_PERSONA_PROMPT}"
-        context_str = "\n".join(context)
-        full_prompt = f"System Prompt: {system_prompt}\n\nContext:\n---\n{context_str}\n---\n\nQuestion: {query}"
+        previous = self._producer
+        if previous is not None and not previous.done() and not previous.cancelling():
+            # The last turn was not cancelled with this conversation's answer, so other visitors who
+            # asked the same question are still listening. Leave that session to them and continue
+            # on a fresh one rather than wait for their answer to finish.
+            print("Previous Mateo turn is still shared with other visitors; leasing a new Live session.")
+            self.live = None
+            self._turn_lock = asyncio.Lock()
+        self._producer = asyncio.current_task()
 
+        # One turn at a time per session; a reused session that fails before any audio is replaced once
+        async with self._turn_lock:
+            for attempt in range(2):
+                live, reused = await self._lease()
+                start = time.perf_counter()
+                first_audio = None
+                live.clean = False
+                try:
+                    await live.session.send_client_content(
+                        turns=[{"role": "user", "parts": [{"text": prompt}]}], turn_complete=True
+                    )
+                    async for response_chunk in live.session.receive():
+                        if response_chunk.data:
+                            if first_audio is None:
+                                first_audio = time.perf_counter() - start
+                                metrics.observe("live_first_audio", first_audio)
+                            yield response_chunk.data
+                    live.clean = True
+                    metrics.observe("live_turn_total", time.perf_counter() - start)
+                except Exception as e:
+                    if first_audio is not None or not reused or attempt:
+                        raise
+                    print(f"Reused Live session failed ({e}); reconnecting.")
+                finally:
+                    live.turns += 1
+                    live.last_used = time.monotonic()
+                    live_sessions.record_turn(reused, first_audio)
+                    # A half-read turn would leak into the next one, and a detached session carries
+                    # history the conversation has moved on from; never reuse either
+                    if not live.clean or self.closed or self.live is not live:
+                        if self.live is live:
+                            self.live = None
+                        await live_sessions.discard(live)
+                if live.clean:
+                    return
+
+    async def generate_and_stream_audio(self, query: str, context: list, websocket=None):
+        websocket = websocket or self.client_websocket
         try:
-            async with client.aio.live.connect(
-                model=config.AUDIO_MODEL_NAME,
-                config=types.LiveConnectConfig(response_modalities=["AUDIO"])
-            ) as google_session:
-                await google_session.send_client_content(
-                    turns=[{"role": "user", "parts": [{"text": full_prompt}]}], turn_complete=True
-                )
-
-                google_turn = google_session.receive()
-                async for response_chunk in google_turn:
-                    if response_chunk.data:
-                        await self.client_websocket.send_bytes(response_chunk.data)
-                
-                print("Audio stream finished.")
-                await self.client_websocket.send_text(json.dumps({"type": "audio_end"}))
+            # Concurrent identical questions share one Live session; latecomers get the buffered prefix
+            key = singleflight.make_key(query, *context)
+            async for chunk in audio_flights.stream(key, lambda: self._live_audio(query, context)):
+                await websocket.send_bytes(chunk)
+
+            print("Audio stream finished.")
+            await websocket.send_text(json.dumps({"type": "audio_end", "persona": "mateo"}))
 
         except Exception as e:
             print(f"Error during audio generation: {e}")
-            await self.client_websocket.send_text(json.dumps({"type": "error", "content": str(e)}))
\ No newline at end of file
+            await websocket.send_text(json.dumps({"type": "error", "persona": "mateo", "content": str(e)}))
+
+    async def close(self):
+        """Ends the conversation; a turn still streaming to other visitors closes the session when done."""
+        self.closed = True
+        if self.live is not None and not self._turn_lock.locked():
+            live, self.live = self.live, None
+            await live_sessions.discard(live)
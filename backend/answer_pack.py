@@ -0,0 +1,403 @@
+"""
+Precomputed answers for known tour questions, served without any live call.
+
+`python -m backend.answer_pack build questions.json` runs every question
+through the normal pipeline (retrieval, Papito's text and read-aloud MP3,
+Mateo's Live audio) with bounded concurrency, per-upstream rate limits and
+retries of transient errors. It writes a pack directory:
+
+    index.json       entries: question, stop, lookup key, TTS key, context fingerprint
+                     and (offset, length) of each blob
+    blob.bin         Papito text, Papito MP3 and Mateo PCM for every entry, concatenated
+    embeddings.npy   (n, dim) float32 sentence embeddings of the questions (see query_embedding)
+
+The server memory-maps the pack at startup. A /ws question that is a packed
+question after normalization is replayed before retrieval or Gemini. A
+paraphrase is replayed only after retrieval, when it returns the same
+context, uses the same question words and its sentence embedding clears
+ANSWER_PACK_THRESHOLD. /synthesize serves the matching MP3 from the pack.
+A pack built from other models, persona prompts or corpus files is refused.
+The question list is JSON (strings or {"question", "stop"} objects) or plain
+text with one question per line.
+"""
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import random
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from . import config
+from . import live_pool
+from . import query_embedding
+from . import response_cache
+from . import retrieval
+from . import singleflight
+
+# --- Configuration ---
+ANSWER_PACK_DIR = os.environ.get("ANSWER_PACK_DIR", "data/answer_pack")
+ANSWER_PACK_ENABLED = os.environ.get("ANSWER_PACK_ENABLED", "1") not in ("0", "false", "False")
+# Sentence-embedding cosine above which a rephrased question counts as the packed one
+ANSWER_PACK_THRESHOLD = float(os.environ.get("ANSWER_PACK_THRESHOLD", 0.85))
+PACK_VERSION = 2
+REPLAY_CHUNK_BYTES = response_cache.AUDIO_BYTES_PER_SECOND // 5
+
+
+def signature() -> str:
+    """Changes whenever a packed answer would come out differently: models, prompts or knowledge."""
+    digest = hashlib.sha1()
+    parts = [config.TEXT_MODEL_NAME, config.AUDIO_MODEL_NAME, config.TEXT_PERSONA_PROMPT,
+             config.AUDIO_PERSONA_PROMPT, retrieval.RETRIEVAL_BACKEND]
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    for path in retrieval.RETRIEVAL_CORPUS:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@dataclass
+class PackEntry:
+    question: str
+    stop: str
+    key: str
+    tts_key: str
+    context: str  # response_cache.context_fingerprint of the retrieved passages
+    text: tuple  # (offset, length) in blob.bin
+    papito_mp3: tuple
+    mateo_pcm: tuple
+
+
+class AnswerPack:
+    def __init__(self, directory: str = ANSWER_PACK_DIR):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json"), "r") as f:
+            index = json.load(f)
+        if index.get("version") != PACK_VERSION:
+            raise ValueError(f"Unsupported answer pack version {index.get('version')}.")
+        self.signature = index.get("signature")
+        self.embedding_model = index.get("embedding_model")
+        self.entries = [PackEntry(**{**e, "text": tuple(e["text"]), "papito_mp3": tuple(e["papito_mp3"]),
+                                     "mateo_pcm": tuple(e["mateo_pcm"])}) for e in index["entries"]]
+        self._by_key = {entry.key: i for i, entry in enumerate(self.entries)}
+        self._by_tts_key = {entry.tts_key: i for i, entry in enumerate(self.entries)}
+        with open(os.path.join(directory, "blob.bin"), "rb") as f:
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self.counters = {"hits": 0, "near_hits": 0, "misses": 0, "speech_hits": 0}
+
+    @property
+    def semantic(self) -> bool:
+        """Whether paraphrases can be matched: the questions were embedded by the model queries use."""
+        return self.embedding_model == query_embedding.QUERY_EMBEDDING_MODEL and len(self.embeddings) == len(self.entries)
+
+    def read(self, span: tuple) -> bytes:
+        offset, length = span
+        return self._blob[offset:offset + length]
+
+    def text(self, entry: PackEntry) -> str:
+        return self.read(entry.text).decode("utf-8")
+
+    def lookup(self, query: str):
+        """The entry for the same question after normalization; needs no retrieval."""
+        index = self._by_key.get(singleflight.make_key(query))
+        if index is None:
+            return None
+        self.counters["hits"] += 1
+        return self.entries[index]
+
+    def lookup_similar(self, query: str, context: list, embedding: np.ndarray, threshold: float = ANSWER_PACK_THRESHOLD):
+        """The closest paraphrase with the same retrieved context, or None."""
+        if embedding is None or not self.semantic or not self.entries:
+            self.counters["misses"] += 1
+            return None
+        fingerprint = response_cache.context_fingerprint(context)
+        scores = np.asarray(self.embeddings @ embedding)
+        for index in np.argsort(-scores):
+            entry = self.entries[index]
+            if scores[index] < threshold:
+                break
+            if entry.context == fingerprint and query_embedding.same_question(
+                    query, entry.question, embedding, self.embeddings[index], threshold):
+                self.counters["near_hits"] += 1
+                return entry
+        self.counters["misses"] += 1
+        return None
+
+    def speech(self, tts_key: str):
+        """Papito's MP3 for a TTS cache key, if this pack has it."""
+        index = self._by_tts_key.get(tts_key)
+        if index is None:
+            return None
+        self.counters["speech_hits"] += 1
+        return self.read(self.entries[index].papito_mp3)
+
+    def messages(self, entry: PackEntry) -> list:
+        """The frames of a live turn, in the order `response_cache.replay_messages` expects."""
+        messages = [("text", json.dumps({"type": "text", "persona": "papito", "content": self.text(entry)}))]
+        offset, length = entry.mateo_pcm
+        for start in range(0, length, REPLAY_CHUNK_BYTES):
+            messages.append(("bytes", self.read((offset + start, min(REPLAY_CHUNK_BYTES, length - start)))))
+        messages.append(("text", json.dumps({"type": "audio_end", "persona": "mateo"})))
+        return messages
+
+    def stats(self) -> dict:
+        return {**self.counters, "entries": len(self.entries)}
+
+
+_pack = None
+_pack_loaded = False
+
+
+def get_pack():
+    """Opens the pack once per process; None when disabled or not built."""
+    global _pack, _pack_loaded
+    if not _pack_loaded:
+        _pack_loaded = True
+        if ANSWER_PACK_ENABLED and os.path.exists(os.path.join(ANSWER_PACK_DIR, "index.json")):
+            try:
+                pack = AnswerPack(ANSWER_PACK_DIR)
+                if pack.signature != signature():
+                    print("Answer pack was built with different models, persona prompts or corpus; not serving it. Rebuild it to match.")
+                else:
+                    _pack = pack
+                    mode = "exact and paraphrase" if pack.semantic else "exact"
+                    print(f"Answer pack loaded: {len(pack.entries)} answers ({mode} matches).")
+            except Exception as e:
+                print(f"Could not open the answer pack: {e}")
+    return _pack
+
+
+def lookup(query: str):
+    pack = get_pack()
+    return pack.lookup(query) if pack is not None else None
+
+
+def lookup_similar(query: str, context: list, embedding):
+    pack = get_pack()
+    return pack.lookup_similar(query, context, embedding) if pack is not None else None
+
+
+def speech(tts_key: str):
+    pack = get_pack()
+    return pack.speech(tts_key) if pack is not None else None
+
+
+async def replay(websocket, entry: PackEntry):
+    await response_cache.replay_messages(websocket, get_pack().messages(entry))
+
+
+def stats() -> dict:
+    pack = get_pack()
+    return pack.stats() if pack is not None else {"entries": 0}
+
+
+# --- Building ---
+class RateLimiter:
+    """Spaces calls to one upstream at most `rate` per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class EmptyAnswer(Exception):
+    """An upstream call that succeeded but produced nothing; worth another try."""
+
+
+def is_transient(e: BaseException) -> bool:
+    """Timeouts, dropped connections, rate limits and server errors; never auth or bad requests."""
+    from websockets.exceptions import ConnectionClosedError
+
+    if isinstance(e, (EmptyAnswer, TimeoutError, asyncio.TimeoutError, ConnectionError, ConnectionClosedError)):
+        return True
+    # google-genai APIError and google-api-core errors both carry the HTTP status as `code`
+    code = getattr(e, "code", None)
+    return isinstance(code, int) and (code == 429 or 500 <= code < 600)
+
+
+async def with_retries(name: str, limiter: RateLimiter, factory, attempts: int = 4):
+    for attempt in range(attempts):
+        await limiter.wait()
+        try:
+            return await factory()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_transient(e):
+                raise
+            delay = 2 ** attempt + random.random()
+            print(f"{name} failed ({e}); retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+
+def read_questions(path: str) -> list:
+    """Returns [(question, stop)] from a JSON or plain-text question list."""
+    with open(path, "r") as f:
+        if path.endswith(".json"):
+            items = json.load(f)
+        else:
+            items = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    questions, seen = [], set()
+    for item in items:
+        question, stop = (item, "") if isinstance(item, str) else (item["question"], item.get("stop", ""))
+        key = singleflight.make_key(question)
+        if key not in seen:
+            seen.add(key)
+            questions.append((question, stop))
+    return questions
+
+
+async def _answer(question: str, limits: dict) -> dict:
+    from . import ai_core
+
+    context = await ai_core.search_knowledge_base(question)
+    text = await with_retries("Papito text", limits["text"], lambda: ai_core.generate_text_response(question, context))
+    tts_key, mp3 = await with_retries("Papito speech", limits["tts"], lambda: ai_core.get_papito_speech(text))
+
+    async def mateo():
+        # A fresh Live session per question, so no answer is shaped by the previous one.
+        # Read Mateo's turn directly rather than through the websocket path, which reports
+        # errors as messages, so with_retries sees the real exception.
+        pcm = bytearray()
+        session = ai_core.MateoAudioSession(None)
+        try:
+            async for chunk in session._live_audio(question, context):
+                pcm.extend(chunk)
+        finally:
+            await session.close()
+        if not pcm:
+            raise EmptyAnswer("Mateo produced no audio.")
+        return bytes(pcm)
+
+    pcm = await with_retries("Mateo audio", limits["live"], mateo)
+    return {"text": text.encode("utf-8"), "tts_key": tts_key, "context": response_cache.context_fingerprint(context),
+            "papito_mp3": mp3, "mateo_pcm": pcm}
+
+
+def _embed_questions(questions: list):
+    """(model name, embeddings), or (None, empty) when the sentence model is unavailable."""
+    try:
+        return query_embedding.QUERY_EMBEDDING_MODEL, query_embedding.embed_many(questions)
+    except Exception as e:
+        print(f"Question embeddings unavailable ({e}); the pack will only match questions exactly.")
+        return None, np.zeros((0, 0), np.float32)
+
+
+def _write_pack(directory: str, entries: list):
+    """Writes blob, embeddings and finally the index, each replaced atomically."""
+    os.makedirs(directory, exist_ok=True)
+    suffix = f".{os.getpid()}.tmp"
+    index_entries, offset = [], 0
+    with open(os.path.join(directory, "blob.bin") + suffix, "wb") as blob:
+        for entry in entries:
+            spans = {}
+            for part in ("text", "papito_mp3", "mateo_pcm"):
+                blob.write(entry[part])
+                spans[part] = [offset, len(entry[part])]
+                offset += len(entry[part])
+            index_entries.append({"question": entry["question"], "stop": entry["stop"], "key": entry["key"],
+                                  "tts_key": entry["tts_key"], "context": entry["context"], **spans})
+    embedding_model, embeddings = _embed_questions([e["question"] for e in entries])
+    with open(os.path.join(directory, "embeddings.npy") + suffix, "wb") as f:
+        np.save(f, embeddings.astype(np.float32))
+    with open(os.path.join(directory, "index.json") + suffix, "w") as f:
+        json.dump({"version": PACK_VERSION, "signature": signature(), "embedding_model": embedding_model,
+                   "created": time.time(), "entries": index_entries}, f)
+    for name in ("blob.bin", "embeddings.npy", "index.json"):
+        os.replace(os.path.join(directory, name) + suffix, os.path.join(directory, name))
+
+
+def _previous_entries(directory: str) -> dict:
+    """Answers from an existing pack built with the same signature, by key."""
+    try:
+        pack = AnswerPack(directory)
+    except Exception:
+        return {}
+    if pack.signature != signature():
+        return {}
+    return {
+        e.key: {"text": pack.read(e.text), "tts_key": e.tts_key, "context": e.context,
+                "papito_mp3": pack.read(e.papito_mp3), "mateo_pcm": pack.read(e.mateo_pcm)}
+        for e in pack.entries
+    }
+
+
+async def build(questions_path: str, directory: str = ANSWER_PACK_DIR, concurrency: int = 4,
+                text_rps: float = 2.0, tts_rps: float = 5.0, live_rps: float = 1.0, force: bool = False) -> dict:
+    from . import ai_core
+
+    questions = read_questions(questions_path)
+    previous = {} if force else _previous_entries(directory)
+    limits = {"text": RateLimiter(text_rps), "tts": RateLimiter(tts_rps), "live": RateLimiter(live_rps)}
+    semaphore = asyncio.Semaphore(concurrency)
+    results, failures = {}, []
+    # No warm sessions: every Live connect happens inside mateo(), behind the live limiter
+    ai_core.live_sessions = live_pool.LiveSessionPool(ai_core._connect_live, min_idle=0, max_idle=0)
+    start = time.perf_counter()
+
+    async def one(question: str, stop: str):
+        key = singleflight.make_key(question)
+        if key in previous:
+            results[key] = {**previous[key], "question": question, "stop": stop, "key": key}
+            return
+        async with semaphore:
+            try:
+                answer = await _answer(question, limits)
+            except Exception as e:
+                print(f"Giving up on '{question}': {e}")
+                failures.append(question)
+                return
+        results[key] = {**answer, "question": question, "stop": stop, "key": key}
+        print(f"[{len(results)}/{len(questions)}] {question}")
+
+    try:
+        await asyncio.gather(*(one(question, stop) for question, stop in questions))
+    finally:
+        await ai_core.live_sessions.close()
+    # Keep the question list's order so stops stay grouped
+    entries = [results[singleflight.make_key(q)] for q, _ in questions if singleflight.make_key(q) in results]
+    _write_pack(directory, entries)
+    summary = {
+        "answers": len(entries), "reused": sum(1 for q, _ in questions if singleflight.make_key(q) in previous),
+        "failed": len(failures), "bytes": os.path.getsize(os.path.join(directory, "blob.bin")),
+        "seconds": round(time.perf_counter() - start, 1),
+    }
+    print(f"Answer pack written to {directory}: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    # python -m backend.answer_pack build <questions.json|.txt> [--out DIR] [--concurrency N]
+    #     [--text-rps R] [--tts-rps R] [--live-rps R] [--force]
+    import argparse
+    import sys
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Precompute tour answers into an answer pack.")
+    parser.add_argument("command", choices=("build",))
+    parser.add_argument("questions")
+    parser.add_argument("--out", default=ANSWER_PACK_DIR)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--text-rps", type=float, default=2.0)
+    parser.add_argument("--tts-rps", type=float, default=5.0)
+    parser.add_argument("--live-rps", type=float, default=1.0)
+    parser.add_argument("--force", action="store_true", help="Regenerate answers already in the pack.")
+    args = parser.parse_args()
+    summary = asyncio.run(build(args.questions, args.out, args.concurrency, args.text_rps, args.tts_rps, args.live_rps, args.force))
+    sys.exit(1 if summary["failed"] else 0)
@@ -0,0 +1,233 @@
+"""
+Framed, backpressure-aware delivery of Mateo's audio to the browser.
+
+Gemini Live emits 24 kHz 16-bit mono PCM in arbitrary chunk sizes. Each
+connection re-chunks it into fixed-duration frames, optionally encodes them
+to Opus (`pip install opuslib`, and only for browsers that can decode it),
+and queues them for a writer task. Every binary message starts with
+
+    version u8 | codec u8 | frame duration ms u16 | sequence number u32
+
+(little-endian), so the client can detect shed frames. The queue is bounded:
+when it is full, `send_bytes` waits for the writer, so a burst (a replay, or
+a latecomer catching up on a shared answer) is paced by the socket rather
+than dropped. Quality follows how far the writer lags behind: once frames
+wait longer than AUDIO_DEGRADE_LAG_MS before going out they are degraded
+(12 kHz PCM or a lower Opus bitrate), and frames that waited longer than
+AUDIO_SHED_LAG_MS are dropped. Only this connection's reader waits; upstream
+generation, which other visitors may share, is never blocked.
+"""
+import asyncio
+import json
+import os
+import struct
+import time
+from collections import deque
+
+import numpy as np
+
+# --- Configuration ---
+AUDIO_FRAME_MS = int(os.environ.get("AUDIO_FRAME_MS", 40))  # Must be an Opus frame size: 10, 20, 40 or 60
+AUDIO_QUEUE_FRAMES = int(os.environ.get("AUDIO_QUEUE_FRAMES", 75))
+AUDIO_OPUS_BITRATE = int(os.environ.get("AUDIO_OPUS_BITRATE", 24000))
+AUDIO_OPUS_DEGRADED_BITRATE = int(os.environ.get("AUDIO_OPUS_DEGRADED_BITRATE", 12000))
+# Time a frame spends queued before the writer sends it; above these the client is falling behind
+AUDIO_DEGRADE_LAG_MS = int(os.environ.get("AUDIO_DEGRADE_LAG_MS", 750))
+AUDIO_SHED_LAG_MS = int(os.environ.get("AUDIO_SHED_LAG_MS", 3000))
+
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+
+HEADER = struct.Struct("<BBHI")
+FRAME_VERSION = 1
+CODEC_PCM16 = 0  # 24 kHz
+CODEC_PCM16_HALF = 1  # 12 kHz, sent while the client is behind
+CODEC_OPUS = 2
+
+try:
+    import opuslib
+except Exception:  # Missing package or missing libopus
+    opuslib = None
+
+counters = {
+    "connections": 0, "pcm_bytes_in": 0, "bytes_out": 0,
+    "frames_sent": 0, "frames_degraded": 0, "frames_shed": 0,
+}
+
+
+def opus_available() -> bool:
+    return opuslib is not None
+
+
+def pack_frame(codec: int, duration_ms: int, sequence: int, payload: bytes) -> bytes:
+    return HEADER.pack(FRAME_VERSION, codec, duration_ms, sequence & 0xFFFFFFFF) + payload
+
+
+def downsample_half(pcm: bytes) -> bytes:
+    """24 kHz -> 12 kHz by averaging sample pairs; halves the bytes on the wire."""
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.int32)
+    if len(samples) % 2:
+        samples = np.append(samples, samples[-1])
+    return ((samples[0::2] + samples[1::2]) // 2).astype("<i2").tobytes()
+
+
+class AudioStream:
+    """Wraps one client websocket; `send_bytes` takes raw PCM, `send_text` passes JSON through."""
+
+    def __init__(self, websocket, codecs=("pcm",), frame_ms: int = AUDIO_FRAME_MS, max_frames: int = AUDIO_QUEUE_FRAMES):
+        self.websocket = websocket
+        self.frame_ms = frame_ms
+        self.frame_bytes = SAMPLE_RATE * frame_ms // 1000 * SAMPLE_WIDTH
+        self.max_frames = max_frames
+        self.sequence = 0
+        self.degraded = False
+        self.lag = 0.0  # Seconds the last frame sent waited in the queue
+        self._pending = bytearray()  # PCM not yet filling a whole frame
+        self._text = deque()  # (persona, message): Papito's messages overtake queued audio
+        self._audio = deque()  # (kind, payload, queued at): Mateo's frames and in-band control messages, in order
+        self._audio_frames = 0
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()  # Set whenever the writer takes a frame off the queue
+        self._error = None
+        self._writer = None
+
+        self.encoder = None
+        if "opus" in codecs and opus_available():
+            self.encoder = opuslib.Encoder(SAMPLE_RATE, 1, opuslib.APPLICATION_VOIP)
+            self.encoder.bitrate = AUDIO_OPUS_BITRATE
+        counters["connections"] += 1
+
+    @property
+    def codec(self) -> str:
+        return "opus" if self.encoder else "pcm"
+
+    def _ensure_writer(self):
+        if self._error is not None:
+            raise self._error
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    # --- Producer side ---
+    def _encode(self, pcm: bytes) -> bytes:
+        duration_ms = len(pcm) * 1000 // (SAMPLE_RATE * SAMPLE_WIDTH)
+        if self.encoder:
+            if len(pcm) < self.frame_bytes:
+                pcm = pcm + bytes(self.frame_bytes - len(pcm))  # Opus only takes whole frames
+            payload, codec, duration_ms = self.encoder.encode(pcm, len(pcm) // SAMPLE_WIDTH), CODEC_OPUS, self.frame_ms
+        elif self.degraded:
+            payload, codec = downsample_half(pcm), CODEC_PCM16_HALF
+        else:
+            payload, codec = pcm, CODEC_PCM16
+        if self.degraded:
+            counters["frames_degraded"] += 1
+        frame = pack_frame(codec, duration_ms, self.sequence, payload)
+        self.sequence += 1
+        return frame
+
+    def _writer_lag(self) -> float:
+        """How far the writer is behind: the wait of the last frame sent or of the oldest one queued."""
+        for kind, _, queued_at in self._audio:
+            if kind == "bytes":
+                return max(self.lag, time.monotonic() - queued_at)
+        return self.lag
+
+    def _update_quality(self):
+        # Hysteresis: degrade past the lag threshold, recover below half of it
+        lag_ms = self._writer_lag() * 1000
+        if not self.degraded and lag_ms >= AUDIO_DEGRADE_LAG_MS:
+            self.degraded = True
+        elif self.degraded and lag_ms <= AUDIO_DEGRADE_LAG_MS / 2:
+            self.degraded = False
+        if self.encoder:
+            self.encoder.bitrate = AUDIO_OPUS_DEGRADED_BITRATE if self.degraded else AUDIO_OPUS_BITRATE
+
+    def _enqueue_frame(self, pcm: bytes):
+        self._update_quality()
+        self._audio.append(("bytes", self._encode(pcm), time.monotonic()))
+        self._audio_frames += 1
+        self._ready.set()
+
+    async def _wait_for_space(self):
+        while self._audio_frames >= self.max_frames:
+            self._space.clear()
+            await self._space.wait()
+            if self._error is not None:
+                raise self._error
+
+    async def send_bytes(self, pcm: bytes):
+        self._ensure_writer()
+        counters["pcm_bytes_in"] += len(pcm)
+        self._pending.extend(pcm)
+        while len(self._pending) >= self.frame_bytes:
+            await self._wait_for_space()
+            self._enqueue_frame(bytes(self._pending[:self.frame_bytes]))
+            del self._pending[:self.frame_bytes]
+
+    def _flush_pending(self):
+        if self._pending:
+            self._enqueue_frame(bytes(self._pending))
+            self._pending.clear()
+
+    async def send_text(self, data: str):
+        self._ensure_writer()
+        persona = json.loads(data).get("persona")
+        if persona == "mateo":
+            # Mateo's audio_end/error must follow his last frame
+            self._flush_pending()
+            self._audio.append(("text", data, None))
+        else:
+            self._text.append((persona, data))
+        self._ready.set()
+
+    def clear_audio(self):
+        """Drops Mateo's queued and partial frames, e.g. when his answer was cancelled."""
+        self._pending.clear()
+        self._audio.clear()
+        self._audio_frames = 0
+        self._space.set()
+
+    def clear_papito(self):
+        """Drops Papito's queued messages, so a cancelled answer's deltas never reach the client."""
+        self._text = deque(item for item in self._text if item[0] != "papito")
+
+    # --- Writer side ---
+    async def _write(self):
+        try:
+            while True:
+                await self._ready.wait()
+                if self._text:
+                    await self.websocket.send_text(self._text.popleft()[1])
+                elif self._audio:
+                    kind, payload, queued_at = self._audio.popleft()
+                    if kind == "text":
+                        await self.websocket.send_text(payload)
+                        continue
+                    self._audio_frames -= 1
+                    self._space.set()
+                    self.lag = time.monotonic() - queued_at
+                    if self.lag * 1000 > AUDIO_SHED_LAG_MS:
+                        # The client is this far behind; skipping stale audio lets it catch up
+                        counters["frames_shed"] += 1
+                        continue
+                    await self.websocket.send_bytes(payload)
+                    counters["frames_sent"] += 1
+                    counters["bytes_out"] += len(payload)
+                else:
+                    self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+            self._space.set()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    def stats(self) -> dict:
+        return {"codec": self.codec, "queued_frames": self._audio_frames, "degraded": self.degraded, "lag_ms": round(self.lag * 1000)}
+
+
+def stats() -> dict:
+    return {**counters, "opus_available": opus_available()}
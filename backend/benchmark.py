@@ -0,0 +1,433 @@
+"""
+Offline load benchmark for the FastAPI app.
+
+Starts the app in a subprocess with local stand-ins for Gemini (text and
+Live audio), Text-to-Speech, CLIP and Elasticsearch, each with configurable
+latency, then drives `/ws`, `/synthesize`, `/qa` and `/image-search` with N
+concurrent clients over real sockets. Reports p50/p95/p99 latency,
+time-to-first-byte and throughput; baselines are plain JSON, so they can be
+committed and compared in review.
+
+    python -m backend.benchmark --clients 16 --requests 8
+    python -m backend.benchmark --save benchmarks/baseline.json
+    python -m backend.benchmark --compare benchmarks/baseline.json
+
+Queries are unique per request so caches and coalescing stay out of the
+numbers; `--repeat` reuses the same questions to measure them instead.
+Retrieval, the executor pools and the websocket pipeline are the real code;
+/qa is answered by a stand-in chain, since the langchain chain needs Elastic.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+
+ENDPOINTS = ("ws", "synthesize", "qa", "image-search")
+QUESTIONS = [
+    "What do manatees eat?", "Where is San San Pond Sak?", "Why are mangroves important?",
+    "What animals live in the wetland?", "How big is the protected area?", "Can I see sea turtles here?",
+    "What is a peat swamp?", "How do the mangrove roots help the coast?",
+]
+SEARCHES = ["a manatee", "a sloth in a tree", "red mangroves", "a toucan", "a poison dart frog", "a heron"]
+
+# Seconds, before --latency-scale; roughly what production traces show
+PROFILE = {
+    "text_first_token": 0.35,
+    "text_tokens_per_second": 120.0,
+    "text_tokens": 120,
+    "live_connect": 0.4,
+    "live_first_audio": 0.6,
+    "live_audio_seconds": 3.0,
+    "live_speedup": 4.0,  # Live generates audio faster than real time
+    "tts_base": 0.15,
+    "tts_per_char": 0.0004,
+    "es_search": 0.03,
+    "clip_batch": 0.02,
+}
+
+AUDIO_CHUNK_SECONDS = 0.1
+AUDIO_BYTES_PER_SECOND = 24000 * 2
+
+
+# --- Stand-ins ---
+class FakeModels:
+    def __init__(self, profile: dict):
+        self.profile = profile
+
+    def _answer(self, contents) -> list:
+        words = str(contents).split()
+        return [words[i % len(words)] for i in range(int(self.profile["text_tokens"]))] if words else ["..."]
+
+    async def generate_content(self, model=None, contents=None, config=None):
+        tokens = self._answer(contents)
+        await asyncio.sleep(self.profile["text_first_token"] + len(tokens) / self.profile["text_tokens_per_second"])
+        return SimpleNamespace(text=" ".join(tokens))
+
+    async def generate_content_stream(self, model=None, contents=None, config=None):
+        async def stream():
+            await asyncio.sleep(self.profile["text_first_token"])
+            tokens = self._answer(contents)
+            for start in range(0, len(tokens), 8):
+                await asyncio.sleep(8 / self.profile["text_tokens_per_second"])
+                yield SimpleNamespace(text=" ".join(tokens[start:start + 8]) + " ")
+        return stream()
+
+
+class FakeLiveSession:
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self._ws = SimpleNamespace(close_code=None)
+        self._turns = 0
+
+    async def send_client_content(self, turns=None, turn_complete=True):
+        self._turns += 1
+
+    async def receive(self):
+        await asyncio.sleep(self.profile["live_first_audio"])
+        chunk = bytes(int(AUDIO_CHUNK_SECONDS * AUDIO_BYTES_PER_SECOND))
+        for _ in range(int(self.profile["live_audio_seconds"] / AUDIO_CHUNK_SECONDS)):
+            yield SimpleNamespace(data=chunk)
+            await asyncio.sleep(AUDIO_CHUNK_SECONDS / self.profile["live_speedup"])
+        yield SimpleNamespace(data=None, server_content=SimpleNamespace(turn_complete=True))
+
+
+class FakeLive:
+    def __init__(self, profile: dict):
+        self.profile = profile
+
+    @contextlib.asynccontextmanager
+    async def connect(self, model=None, config=None):
+        await asyncio.sleep(self.profile["live_connect"])
+        session = FakeLiveSession(self.profile)
+        try:
+            yield session
+        finally:
+            session._ws.close_code = 1000
+
+
+class FakeGenaiClient:
+    """Just the `client.aio` surface that ai_core uses."""
+
+    def __init__(self, profile: dict):
+        self.aio = SimpleNamespace(models=FakeModels(profile), live=FakeLive(profile))
+
+
+class FakeTTSClient:
+    def __init__(self, profile: dict):
+        self.profile = profile
+
+    async def synthesize_speech(self, input=None, voice=None, audio_config=None):
+        text = input.ssml or input.text or ""
+        await asyncio.sleep(self.profile["tts_base"] + len(text) * self.profile["tts_per_char"])
+        return SimpleNamespace(audio_content=b"\xff\xf3" + bytes(len(text) * 40))
+
+
+class FakeAsyncElasticsearch:
+    def __init__(self, profile: dict):
+        self.profile = profile
+
+    async def search(self, index=None, knn=None, query=None, source=None, size=None, **kwargs):
+        await asyncio.sleep(self.profile["es_search"])
+        k = (knn or {}).get("k", size or 5)
+        hits = [
+            {"_index": index, "_id": str(i), "_score": 1.0 - i / 100, "_source": {
+                "photo_image_url": f"https://images.example/{i}.jpg", "photo_description": "stand-in", "label": "manatee",
+            }}
+            for i in range(k)
+        ]
+        return SimpleNamespace(body={"hits": {"hits": hits}})
+
+    async def bulk(self, operations=None, **kwargs):
+        actions = list(operations or [])[::2]
+        await asyncio.sleep(self.profile["es_search"] + len(actions) * 0.0005)
+        return {"errors": False, "items": [{"index": {"status": 201}} for _ in actions]}
+
+    async def close(self):
+        pass
+
+
+class FakeClipEncoder:
+    def __init__(self, profile: dict):
+        self.profile = profile
+
+    def encode_texts(self, texts: list) -> np.ndarray:
+        time.sleep(self.profile["clip_batch"])  # Runs on the "clip" pool like the real forward pass
+        return np.stack([np.random.default_rng(zlib.crc32(t.encode())).standard_normal(512) for t in texts]).astype(np.float32)
+
+
+class FakeQAService:
+    def __init__(self, profile: dict):
+        self.es = FakeAsyncElasticsearch(profile)
+        self.models = FakeModels(profile)
+
+    async def ainvoke(self, question: str) -> str:
+        hits = await self.es.search(index="docs", size=4)
+        context = " ".join(hit["_source"]["photo_description"] for hit in hits.body["hits"]["hits"])
+        response = await self.models.generate_content(contents=f"{context} {question}")
+        return response.text
+
+
+def install_fakes(profile: dict):
+    """Points the app's upstream clients at the stand-ins; call before the app starts."""
+    from . import ai_core, image_search, subsystems
+
+    ai_core.client = FakeGenaiClient(profile)
+    ai_core.tts_enabled = True
+    ai_core._tts_client = FakeTTSClient(profile)
+
+    image_search.IMAGE_SEARCH_BACKEND = "elasticsearch"
+    image_search.encoder = FakeClipEncoder(profile)
+    es = FakeAsyncElasticsearch(profile)
+    image_search.get_async_es_client = lambda: es
+
+    qa = subsystems.get("qa")
+    qa._module = SimpleNamespace(service=FakeQAService(profile), QANotConfiguredError=RuntimeError)
+    qa.state = subsystems.READY
+
+
+def serve(port: int, latency_scale: float):
+    import uvicorn
+
+    profile = {key: value * latency_scale if key not in ("text_tokens_per_second", "text_tokens", "live_speedup", "live_audio_seconds")
+               else value for key, value in PROFILE.items()}
+    install_fakes(profile)
+    from . import main
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+# --- Load generation ---
+def _query(pool: list, client: int, request: int, repeat: bool) -> str:
+    text = pool[(client + request) % len(pool)]
+    return text if repeat else f"{text} (visitor {client}, question {request})"
+
+
+async def ws_client(base_url: str, client: int, requests: int, repeat: bool, samples: list):
+    import websockets
+
+    async with websockets.connect(f"{base_url.replace('http', 'ws', 1)}/ws?codecs=pcm", max_size=None) as ws:
+        for request in range(requests):
+            start = time.perf_counter()
+            first = first_audio = error = None
+            text_done = audio_done = False
+            await ws.send(_query(QUESTIONS, client, request, repeat))
+            while not (text_done and audio_done):
+                message = await ws.recv()
+                now = time.perf_counter() - start
+                first = first if first is not None else now
+                if isinstance(message, bytes):
+                    first_audio = first_audio if first_audio is not None else now
+                    continue
+                message = json.loads(message)
+                if message["type"] in ("text", "text_end"):
+                    text_done = True
+                elif message["type"] == "audio_end":
+                    audio_done = True
+                elif message["type"] == "error":
+                    error = message.get("content")
+                    text_done = text_done or message.get("persona") != "mateo"
+                    audio_done = audio_done or message.get("persona") != "papito"
+            samples.append({"latency": time.perf_counter() - start, "ttfb": first, "ttfa": first_audio, "error": error})
+
+
+async def http_client(http, endpoint: str, client: int, requests: int, repeat: bool, samples: list):
+    for request in range(requests):
+        if endpoint == "synthesize":
+            body = {"text": _query(QUESTIONS, client, request, repeat) + " Manatees graze on seagrass in the lagoon."}
+        elif endpoint == "qa":
+            body = {"question": _query(QUESTIONS, client, request, repeat)}
+        else:
+            body = {"query": _query(SEARCHES, client, request, repeat)}
+        start = time.perf_counter()
+        error = None
+        try:
+            async with http.stream("POST", f"/{endpoint}", json=body) as response:
+                ttfb = time.perf_counter() - start
+                await response.aread()
+                if response.status_code >= 400:
+                    error = f"HTTP {response.status_code}"
+        except Exception as e:
+            ttfb, error = None, str(e)
+        samples.append({"latency": time.perf_counter() - start, "ttfb": ttfb, "error": error})
+
+
+async def run_endpoint(base_url: str, endpoint: str, clients: int, requests: int, repeat: bool) -> tuple:
+    import httpx
+
+    samples = []
+    start = time.perf_counter()
+    if endpoint == "ws":
+        await asyncio.gather(*(ws_client(base_url, c, requests, repeat, samples) for c in range(clients)))
+    else:
+        limits = httpx.Limits(max_connections=clients)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as http:
+            await asyncio.gather(*(http_client(http, endpoint, c, requests, repeat, samples) for c in range(clients)))
+    return samples, time.perf_counter() - start
+
+
+def _percentiles(values: list) -> dict:
+    values = [v for v in values if v is not None]
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(p50 * 1000, 1), "p95": round(p95 * 1000, 1), "p99": round(p99 * 1000, 1)}
+
+
+def summarize(samples: list, wall_seconds: float) -> dict:
+    ok = [s for s in samples if s["error"] is None]
+    summary = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput_rps": round(len(ok) / wall_seconds, 2) if wall_seconds else 0.0,
+        "latency_ms": _percentiles([s["latency"] for s in ok]),
+        "ttfb_ms": _percentiles([s["ttfb"] for s in ok]),
+    }
+    if any("ttfa" in s for s in ok):
+        summary["ttfa_ms"] = _percentiles([s.get("ttfa") for s in ok])
+    return summary
+
+
+# --- Reporting ---
+def print_report(results: dict):
+    print(f"{'endpoint':<14}{'reqs':>6}{'errs':>6}{'rps':>9}  {'latency p50/p95/p99 ms':<26}{'ttfb p50/p95/p99 ms':<26}")
+    for endpoint, summary in results.items():
+        cells = []
+        for metric in ("latency_ms", "ttfb_ms"):
+            p = summary[metric]
+            cells.append(f"{p.get('p50', '-')}/{p.get('p95', '-')}/{p.get('p99', '-')}")
+        print(f"{endpoint:<14}{summary['requests']:>6}{summary['errors']:>6}{summary['throughput_rps']:>9}  {cells[0]:<26}{cells[1]:<26}")
+        if "ttfa_ms" in summary:
+            p = summary["ttfa_ms"]
+            print(f"{'':<14}time to first audio p50/p95/p99 ms: {p.get('p50', '-')}/{p.get('p95', '-')}/{p.get('p99', '-')}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns human-readable regressions: a percentile slower than baseline by more than `tolerance`."""
+    regressions = []
+    for endpoint, summary in results.items():
+        old = baseline.get("results", {}).get(endpoint)
+        if old is None:
+            continue
+        for metric in ("latency_ms", "ttfb_ms", "ttfa_ms"):
+            for percentile, value in summary.get(metric, {}).items():
+                before = old.get(metric, {}).get(percentile)
+                # Ignore sub-5 ms differences; they are scheduler noise at these latencies
+                if before and value > before * (1 + tolerance) and value - before > 5:
+                    regressions.append(f"{endpoint} {metric} {percentile}: {before} -> {value} (+{(value / before - 1) * 100:.0f}%)")
+        if summary["errors"] > old.get("errors", 0):
+            regressions.append(f"{endpoint} errors: {old.get('errors', 0)} -> {summary['errors']}")
+    return regressions
+
+
+@contextlib.contextmanager
+def app_server(port: int, latency_scale: float, repeat: bool, verbose: bool):
+    cache_dir = tempfile.mkdtemp(prefix="terratale-bench-")
+    env = {
+        **os.environ,
+        "FAST_START": "0",
+        "WARMUP_SUBSYSTEMS": "retrieval,image_search",
+        "TTS_CACHE_DIR": cache_dir,
+        "SEMANTIC_CACHE_ENABLED": "1" if repeat else "0",
+        "OTEL_TRACES_EXPORTER": "none",
+    }
+    command = [sys.executable, "-m", "backend.benchmark", "serve", "--port", str(port), "--latency-scale", str(latency_scale)]
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=output, stderr=output)
+    try:
+        yield process
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def wait_ready(base_url: str, process, timeout: float = 120):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("The benchmark server exited during startup; rerun with --verbose.")
+            with contextlib.suppress(httpx.TransportError):
+                if (await http.get("/readyz")).status_code == 200:
+                    return
+            await asyncio.sleep(0.2)
+    raise TimeoutError("The benchmark server did not become ready.")
+
+
+async def benchmark(args) -> dict:
+    base_url = f"http://127.0.0.1:{args.port}"
+    with app_server(args.port, args.latency_scale, args.repeat, args.verbose) as process:
+        await wait_ready(base_url, process)
+        # One short warm-up round so connection setup and lazy pools are not measured
+        for endpoint in args.endpoints:
+            await run_endpoint(base_url, endpoint, 1, 1, args.repeat)
+        results = {}
+        for endpoint in args.endpoints:
+            samples, wall = await run_endpoint(base_url, endpoint, args.clients, args.requests, args.repeat)
+            results[endpoint] = summarize(samples, wall)
+    return results
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", nargs="?", default="run", choices=("run", "serve"))
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=8, help="Requests per client.")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplies every stand-in latency.")
+    parser.add_argument("--repeat", action="store_true", help="Reuse questions so caches and coalescing apply.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--save", help="Write the results as a baseline JSON file.")
+    parser.add_argument("--compare", help="Compare against a baseline JSON file; exit 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown before a percentile regresses.")
+    parser.add_argument("--verbose", action="store_true", help="Show the server's output.")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.port, args.latency_scale)
+        return 0
+
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(benchmark(args))
+    print_report(results)
+
+    config = {key: getattr(args, key) for key in ("clients", "requests", "latency_scale", "repeat")}
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"config": config, "profile": PROFILE, "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"Warning: baseline was recorded with {baseline.get('config')}, this run used {config}.")
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
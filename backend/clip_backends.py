@@ -0,0 +1,238 @@
+"""
+Selectable CPU inference backends for the CLIP text and image encoders.
+
+    torch       fp32 PyTorch (the reference)
+    torch-int8  PyTorch with dynamic int8 quantization of the Linear layers
+    onnx        ONNX Runtime graphs exported from the fp32 model
+    onnx-int8   ONNX Runtime graphs with dynamically quantized int8 weights
+
+The ONNX backends never keep the PyTorch model in memory: the graphs are
+exported once into CLIP_ONNX_DIR and later workers only load the graphs.
+`parity_check()` measures recall@k of a backend's text embeddings against an
+fp32-built index, and after a full re-index with the backend, before it is
+trusted in production (`python -m backend.clip_backends parity ...`). Image
+indexing is pinned to fp32 torch by image_search.CLIP_INDEX_BACKEND.
+"""
+import os
+
+import numpy as np
+
+# --- Configuration ---
+CLIP_BACKEND = os.environ.get("CLIP_BACKEND", "torch")
+CLIP_ONNX_DIR = os.environ.get("CLIP_ONNX_DIR", os.path.join(os.path.dirname(__file__), ".cache", "clip-onnx"))
+# Threads per worker; several uvicorn workers each using every core just contend.
+CLIP_NUM_THREADS = int(os.environ.get("CLIP_NUM_THREADS", 0)) or None
+CLIP_PARITY_MIN_RECALL = float(os.environ.get("CLIP_PARITY_MIN_RECALL", 0.9))
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+# Held-out queries for parity checks; the kind of thing visitors actually search for.
+PARITY_QUERIES = [
+    "a manatee swimming", "a sloth in a tree", "a red mangrove forest", "a toucan",
+    "a poison dart frog", "a howler monkey", "a heron in a wetland", "a caiman in the water",
+    "a sea turtle on the beach", "a hummingbird", "a river at sunset", "a butterfly on a flower",
+    "a crab on the roots", "a green iguana", "a kingfisher", "a dolphin jumping",
+]
+
+
+class TorchEncoder:
+    def __init__(self, model_name: str, token: str = None, quantize: bool = False):
+        import torch
+        from transformers import CLIPModel, CLIPProcessor
+
+        if CLIP_NUM_THREADS:
+            torch.set_num_threads(CLIP_NUM_THREADS)
+        self.device = "cuda" if torch.cuda.is_available() and not quantize else "cpu"
+        self.processor = CLIPProcessor.from_pretrained(model_name, token=token)
+        model = CLIPModel.from_pretrained(model_name, token=token).eval()
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model.to(self.device)
+
+    def encode_texts(self, texts: list) -> np.ndarray:
+        import torch
+        inputs = self.processor(text=texts, padding=True, return_tensors="pt")
+        with torch.inference_mode():
+            features = self.model.get_text_features(
+                input_ids=inputs.input_ids.to(self.device), attention_mask=inputs.attention_mask.to(self.device)
+            )
+        return features.cpu().numpy()
+
+    def encode_images(self, images: list) -> np.ndarray:
+        import torch
+        # Images arrive already resized and cropped; only normalize here
+        inputs = self.processor(images=images, return_tensors="pt", do_resize=False, do_center_crop=False)
+        with torch.inference_mode():
+            features = self.model.get_image_features(pixel_values=inputs.pixel_values.to(self.device))
+        return features.cpu().numpy()
+
+
+# --- ONNX ---
+def _onnx_paths(model_name: str, quantized: bool) -> dict:
+    directory = os.path.join(CLIP_ONNX_DIR, model_name.replace("/", "--"))
+    suffix = ".int8.onnx" if quantized else ".onnx"
+    return {part: os.path.join(directory, part + suffix) for part in ("text", "image")}
+
+
+def export_onnx(model_name: str, token: str = None, quantized: bool = False) -> dict:
+    """Exports the text and image encoders to ONNX (and optionally int8) if not already present."""
+    paths = _onnx_paths(model_name, quantized)
+    if all(os.path.exists(p) for p in paths.values()):
+        return paths
+
+    fp32_paths = _onnx_paths(model_name, False)
+    if not all(os.path.exists(p) for p in fp32_paths.values()):
+        import torch
+        from transformers import CLIPModel
+
+        print(f"Exporting {model_name} to ONNX...")
+        model = CLIPModel.from_pretrained(model_name, token=token).eval()
+
+        class TextEncoder(torch.nn.Module):
+            def forward(self, input_ids, attention_mask):
+                return model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+        class ImageEncoder(torch.nn.Module):
+            def forward(self, pixel_values):
+                return model.get_image_features(pixel_values=pixel_values)
+
+        os.makedirs(os.path.dirname(fp32_paths["text"]), exist_ok=True)
+        # Export under a private name so concurrently starting workers never load a partial graph
+        tmp_paths = {part: f"{path}.{os.getpid()}.tmp" for part, path in fp32_paths.items()}
+        dummy_ids = torch.ones((2, 8), dtype=torch.long)
+        torch.onnx.export(
+            TextEncoder(), (dummy_ids, torch.ones_like(dummy_ids)), tmp_paths["text"],
+            input_names=["input_ids", "attention_mask"], output_names=["embeds"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "embeds": {0: "batch"}},
+            opset_version=17,
+        )
+        torch.onnx.export(
+            ImageEncoder(), (torch.zeros((2, 3, 224, 224)),), tmp_paths["image"],
+            input_names=["pixel_values"], output_names=["embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "embeds": {0: "batch"}},
+            opset_version=17,
+        )
+        for part, path in fp32_paths.items():
+            os.replace(tmp_paths[part], path)
+
+    if quantized:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        for part in ("text", "image"):
+            tmp_path = f"{paths[part]}.{os.getpid()}.tmp"
+            quantize_dynamic(fp32_paths[part], tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, paths[part])
+    return paths
+
+
+class OnnxEncoder:
+    def __init__(self, model_name: str, token: str = None, quantized: bool = False):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The onnx CLIP backends need `pip install onnxruntime`.") from e
+        from transformers import CLIPProcessor
+
+        paths = export_onnx(model_name, token, quantized)
+        options = ort.SessionOptions()
+        if CLIP_NUM_THREADS:
+            options.intra_op_num_threads = CLIP_NUM_THREADS
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.text_session = ort.InferenceSession(paths["text"], options, providers=providers)
+        self.image_session = ort.InferenceSession(paths["image"], options, providers=providers)
+        self.processor = CLIPProcessor.from_pretrained(model_name, token=token)
+
+    def encode_texts(self, texts: list) -> np.ndarray:
+        inputs = self.processor(text=texts, padding=True, return_tensors="np")
+        feeds = {"input_ids": inputs["input_ids"].astype(np.int64), "attention_mask": inputs["attention_mask"].astype(np.int64)}
+        return self.text_session.run(["embeds"], feeds)[0]
+
+    def encode_images(self, images: list) -> np.ndarray:
+        inputs = self.processor(images=images, return_tensors="np", do_resize=False, do_center_crop=False)
+        return self.image_session.run(["embeds"], {"pixel_values": inputs["pixel_values"].astype(np.float32)})[0]
+
+
+def load_encoder(model_name: str, backend: str = CLIP_BACKEND, token: str = None):
+    """Loads the CLIP encoder for the configured backend."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CLIP_BACKEND '{backend}'; expected one of {', '.join(BACKENDS)}.")
+    print(f"Loading CLIP encoder ({backend})...")
+    if backend.startswith("onnx"):
+        return OnnxEncoder(model_name, token, quantized=backend == "onnx-int8")
+    return TorchEncoder(model_name, token, quantize=backend == "torch-int8")
+
+
+# --- Parity ---
+def _normalized(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def parity_check(candidate, reference, images: list, queries: list = PARITY_QUERIES, k: int = 5) -> dict:
+    """Compares a candidate encoder against the fp32 reference on a held-out set.
+
+    The stored image index is built with the reference encoder (see
+    image_search.CLIP_INDEX_BACKEND), so recall@k measures the production
+    case: the overlap between the reference top-k and the top-k for candidate
+    text embeddings searched against the reference image embeddings.
+    `self_recall_at_k` is the same measure with the images also embedded by
+    the candidate, for an index re-built with CLIP_INDEX_BACKEND set to it.
+    """
+    ref_text, cand_text = _normalized(reference.encode_texts(queries)), _normalized(candidate.encode_texts(queries))
+    ref_images, cand_images = _normalized(reference.encode_images(images)), _normalized(candidate.encode_images(images))
+    k = min(k, len(images))
+
+    def top(text, image_vectors):
+        return np.argsort(-(text @ image_vectors.T), axis=1)[:, :k]
+
+    def recall(expected, found):
+        return float(np.mean([len(set(r) & set(c)) / k for r, c in zip(expected, found)]))
+
+    ref_top = top(ref_text, ref_images)
+    return {
+        "recall_at_k": recall(ref_top, top(cand_text, ref_images)),
+        "self_recall_at_k": recall(ref_top, top(cand_text, cand_images)),
+        "k": k,
+        "text_cosine": float(np.mean(np.sum(ref_text * cand_text, axis=1))),
+        "image_cosine": float(np.mean(np.sum(ref_images * cand_images, axis=1))),
+    }
+
+
+if __name__ == "__main__":
+    # python -m backend.clip_backends parity <backend> <image dir> [k]
+    # python -m backend.clip_backends export [onnx|onnx-int8]
+    import sys
+    import time
+
+    from . import image_pipeline
+
+    model_name = os.environ.get("CLIP_MODEL_NAME", "openai/clip-vit-base-patch32")
+    token = os.environ.get("HUGGING_FACE_HUB_TOKEN")
+    command = sys.argv[1] if len(sys.argv) > 1 else "parity"
+
+    if command == "export":
+        print(export_onnx(model_name, token, quantized=len(sys.argv) > 2 and sys.argv[2] == "onnx-int8"))
+        sys.exit(0)
+
+    backend, image_dir = sys.argv[2], sys.argv[3]
+    k = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        with open(os.path.join(image_dir, name), "rb") as f:
+            try:
+                images.append(image_pipeline.decode_and_resize(f.read()))
+            except Exception:
+                continue
+    print(f"Parity check of {backend} against torch fp32 on {len(images)} images, {len(PARITY_QUERIES)} queries")
+
+    reference = load_encoder(model_name, "torch", token)
+    candidate = load_encoder(model_name, backend, token)
+    for name, encoder in (("torch", reference), (backend, candidate)):
+        encoder.encode_texts(PARITY_QUERIES[:1])  # Warm up
+        start = time.perf_counter()
+        encoder.encode_texts(PARITY_QUERIES[:1])
+        print(f"{name}: single-query text encode {(time.perf_counter() - start) * 1000:.1f} ms")
+    result = parity_check(candidate, reference, images, k=k)
+    print(result)
+    # Both must hold: the index may be built with either encoder
+    passed = min(result["recall_at_k"], result["self_recall_at_k"]) >= CLIP_PARITY_MIN_RECALL
+    sys.exit(0 if passed else 1)
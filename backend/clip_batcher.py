@@ -0,0 +1,135 @@
+"""
+Dynamic micro-batching for CLIP text queries.
+
+Concurrent `/image-search` requests are collected for a short window (or until
+the batch is full) and encoded in one forward pass on the "clip" pool; each
+caller then gets its own row back. Normalized embeddings are kept in an LRU,
+since visitors search for the same few animals over and over.
+"""
+import asyncio
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import executor
+from . import metrics
+
+# --- Configuration ---
+CLIP_BATCH_WINDOW_MS = float(os.environ.get("CLIP_BATCH_WINDOW_MS", 5))
+CLIP_MAX_BATCH = int(os.environ.get("CLIP_MAX_BATCH", 32))
+CLIP_QUERY_CACHE_SIZE = int(os.environ.get("CLIP_QUERY_CACHE_SIZE", 2048))
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class TextEncoderBatcher:
+    def __init__(self, encode_batch, window_ms: float = CLIP_BATCH_WINDOW_MS,
+                 max_batch: int = CLIP_MAX_BATCH, cache_size: int = CLIP_QUERY_CACHE_SIZE):
+        self.encode_batch = encode_batch  # list[str] -> (n, dim) array, blocking
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+        self.counters = {"requests": 0, "cache_hits": 0, "batches": 0, "encoded": 0}
+
+    # --- Cache ---
+    def _cache_get(self, key: str):
+        with self._cache_lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            return vector
+
+    def _cache_put(self, key: str, vector: np.ndarray):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # --- Batching ---
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def encode(self, text: str) -> np.ndarray:
+        """Returns the L2-normalized embedding for `text`."""
+        self.counters["requests"] += 1
+        key = normalize_query(text)
+        vector = self._cache_get(key)
+        if vector is not None:
+            self.counters["cache_hits"] += 1
+            return vector
+
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((key, future))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            waiters = {}
+            for key, future in batch:
+                # Queued before an earlier batch cached this text
+                cached = self._cache_get(key)
+                if cached is not None:
+                    self.counters["cache_hits"] += 1
+                    if not future.done():
+                        future.set_result(cached)
+                    continue
+                waiters.setdefault(key, []).append(future)
+            texts = list(waiters)
+            if not texts:
+                continue
+            try:
+                with metrics.span("clip_encode", batch=len(texts)):
+                    vectors = await executor.run("clip", self.encode_batch, texts)
+                vectors = np.asarray(vectors, dtype=np.float32)
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            except Exception as e:
+                for futures in waiters.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                continue
+
+            self.counters["batches"] += 1
+            self.counters["encoded"] += len(texts)
+            for text, vector in zip(texts, vectors):
+                self._cache_put(text, vector)
+                for future in waiters[text]:
+                    if not future.done():
+                        future.set_result(vector)
+
+    def stats(self) -> dict:
+        batches = self.counters["batches"]
+        return {
+            **self.counters,
+            "mean_batch_size": self.counters["encoded"] / batches if batches else 0.0,
+            "cache_entries": len(self._cache),
+        }
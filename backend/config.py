@@ -10,4 +10,12 @@ AUDIO_PERSONA_PROMPT = """You are Mateo, a playful manatee. Your tone is fun, ge
 
 # --- Model Configuration ---
 TEXT_MODEL_NAME = "models/gemini-2.5-flash"
-AUDIO_MODEL_NAME = "gemini-2.5-flash-native-audio-preview-09-2025"
\ No newline at end of file
+AUDIO_MODEL_NAME = "gemini-2.5-flash-native-audio-preview-09-2025"
+
+# --- Response Configuration ---
+# Stream Papito's answer as incremental `text_delta` frames instead of one `text` message.
+TEXT_STREAMING = True
+# A new question on a websocket cancels the answer still in progress.
+BARGE_IN = True
+# Questions a single websocket may queue while an answer is in progress.
+MAX_PENDING_QUERIES = 4
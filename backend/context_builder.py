@@ -0,0 +1,185 @@
+"""
+Token-budgeted prompt context for both personas.
+
+Retrieved passages are re-ranked (retrieval rank plus coverage of the query
+terms), near-duplicates are dropped, and the rest is packed into the
+persona's budget: Papito writes a full answer, Mateo needs only a sentence or
+two. Token counts are estimates (see qa_indexer.estimate_tokens), and the
+persona prompts' counts are cached. `SystemInstructionCache` keeps the static
+system instruction in Gemini's context cache when the model and credentials
+allow it (the instruction must reach the model's minimum cacheable size), and
+falls back to sending it inline; the cache is created off the request path.
+"""
+import asyncio
+import functools
+import hashlib
+import os
+import re
+import time
+from dataclasses import dataclass
+
+from google.genai import types
+
+from . import metrics
+from .qa_indexer import estimate_tokens
+from .retrieval import tokenize
+
+# --- Configuration ---
+CONTEXT_BUDGETS = {
+    "papito": int(os.environ.get("PAPITO_CONTEXT_TOKENS", 1200)),
+    "mateo": int(os.environ.get("MATEO_CONTEXT_TOKENS", 300)),
+}
+CONTEXT_DEDUPE_JACCARD = float(os.environ.get("CONTEXT_DEDUPE_JACCARD", 0.8))
+# A passage cut shorter than this is not worth its framing; it is dropped instead
+CONTEXT_MIN_PARTIAL_TOKENS = 40
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "1") not in ("0", "false", "False")
+GEMINI_CONTEXT_CACHE_TTL_S = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL_S", 3600))
+# After a failed cache creation, retry this much later
+GEMINI_CONTEXT_CACHE_RETRY_S = 1800
+# Minimum cached-content size per model family (prefix match, first match wins; the last is the default)
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = (("gemini-2.5-flash", 1024), ("gemini-2.5-pro", 4096), ("", 4096))
+
+prompt_tokens = metrics.Histogram(
+    "terratale_prompt_tokens", "Estimated prompt tokens per request.", "persona",
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+metrics.register(prompt_tokens)
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+@functools.lru_cache(maxsize=32)
+def count_prompt_tokens(text: str) -> int:
+    """Token count of a static prompt; the persona prompts are counted once per process."""
+    return estimate_tokens(text)
+
+
+@dataclass
+class BuiltContext:
+    persona: str
+    passages: list
+    tokens: int
+    retrieved: int
+    dropped: int
+
+    def prompt(self, query: str) -> str:
+        context_str = "\n".join(self.passages)
+        return f"Context:\n---\n{context_str}\n---\n\nQuestion: {query}"
+
+
+def _rank(query: str, passages: list) -> list:
+    """Retrieval order stays the main signal; coverage of the query terms breaks near-ties."""
+    query_terms = set(tokenize(query))
+    scored = []
+    for rank, text in enumerate(passages):
+        coverage = len(query_terms & set(tokenize(text))) / len(query_terms) if query_terms else 0.0
+        scored.append((1.0 / (1 + rank) + 0.5 * coverage, rank, text))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [text for _, _, text in scored]
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Keeps whole sentences up to `max_tokens`."""
+    kept, tokens = [], 0
+    for sentence in _SENTENCE_RE.split(text):
+        n = estimate_tokens(sentence)
+        if tokens + n > max_tokens:
+            break
+        kept.append(sentence)
+        tokens += n
+    return " ".join(kept)
+
+
+def build(query: str, passages: list, persona: str) -> BuiltContext:
+    budget = CONTEXT_BUDGETS[persona]
+    selected, selected_terms, tokens = [], [], 0
+    for text in _rank(query, passages):
+        terms = set(tokenize(text))
+        if any(len(terms & seen) / max(1, len(terms | seen)) >= CONTEXT_DEDUPE_JACCARD for seen in selected_terms):
+            continue
+        n = estimate_tokens(text)
+        if tokens + n > budget:
+            remaining = budget - tokens
+            if remaining < CONTEXT_MIN_PARTIAL_TOKENS:
+                break
+            text = _truncate(text, remaining)
+            if not text:
+                break
+            n = estimate_tokens(text)
+        selected.append(text)
+        selected_terms.append(terms)
+        tokens += n
+    return BuiltContext(persona, selected, tokens, len(passages), len(passages) - len(selected))
+
+
+def log_prompt_size(built: BuiltContext, system_prompt: str, query: str, cached_system: bool = False):
+    system = count_prompt_tokens(system_prompt)
+    question = estimate_tokens(query)
+    total = built.tokens + question + (0 if cached_system else system)
+    prompt_tokens.observe(built.persona, total)
+    print(
+        f"Prompt size ({built.persona}): ~{total} tokens = system {system}{' (cached)' if cached_system else ''}"
+        f" + context {built.tokens} ({len(built.passages)}/{built.retrieved} passages) + question {question}"
+    )
+
+
+def min_cache_tokens(model: str) -> int:
+    """Smallest prompt Gemini accepts as cached content for `model`."""
+    for prefix, tokens in GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        if model.startswith(prefix):
+            return tokens
+    return GEMINI_CONTEXT_CACHE_MIN_TOKENS[-1][1]
+
+
+class SystemInstructionCache:
+    """Gemini cached content holding one static system instruction per model.
+
+    `get()` never waits on the API: it returns the current cache name, or
+    None to send the instruction inline, and creates or renews the cache in
+    a background task.
+    """
+
+    def __init__(self, ttl: int = GEMINI_CONTEXT_CACHE_TTL_S):
+        self.ttl = ttl
+        self._entries = {}  # (model, sha1 of instruction) -> (cache name, expires at)
+        self._unavailable_until = {}
+        self._refreshing = {}  # key -> task
+
+    def get(self, client, model: str, instruction: str):
+        """Returns the cached content name, or None when the instruction must be sent inline."""
+        if not GEMINI_CONTEXT_CACHE or client is None:
+            return None
+        key = (model, hashlib.sha1(instruction.encode("utf-8")).hexdigest())
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        # Renew a little before the server-side expiry
+        if entry is None or entry[1] - 60 <= now:
+            self._refresh(key, client, model, instruction, now)
+        if entry and entry[1] > now:
+            return entry[0]
+        return None
+
+    def _refresh(self, key: tuple, client, model: str, instruction: str, now: float):
+        if key in self._refreshing or self._unavailable_until.get(key, 0) > now:
+            return
+        if count_prompt_tokens(instruction) < min_cache_tokens(model):
+            # Below the model's minimum, creation can only fail; don't ask again
+            self._unavailable_until[key] = float("inf")
+            return
+        task = self._refreshing[key] = asyncio.create_task(self._create(key, client, model, instruction))
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    async def _create(self, key: tuple, client, model: str, instruction: str):
+        try:
+            cached = await client.aio.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(system_instruction=instruction, ttl=f"{self.ttl}s"),
+            )
+        except Exception as e:
+            print(f"Gemini context caching unavailable for {model}; sending the system instruction inline ({e}).")
+            self._unavailable_until[key] = time.monotonic() + GEMINI_CONTEXT_CACHE_RETRY_S
+            return
+        self._entries[key] = (cached.name, time.monotonic() + self.ttl)
+
+
+system_cache = SystemInstructionCache()
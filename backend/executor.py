@@ -0,0 +1,140 @@
+"""
+Bounded thread pools for the synchronous work that has no native async client.
+
+Everything that would otherwise block the event loop (CLIP forward passes,
+file IO, legacy sync SDK calls) goes through `run()` on a named pool, so one
+slow upstream can only ever exhaust its own pool.
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Configuration ---
+# Pool sizes are "<workers>:<max queued>", e.g. EXECUTOR_POOL_CLIP="2:32".
+DEFAULT_POOLS = {
+    "default": "4:64",
+    "tts": "4:64",
+    "clip": "1:32",
+    # Subsystem imports and model loads; kept apart so they never hold chat-path threads
+    "subsystems": "2:16",
+}
+
+
+class PoolSaturatedError(RuntimeError):
+    """Raised when a pool's queue is full and the call is rejected."""
+
+
+def _pool_spec(name: str) -> tuple:
+    spec = os.environ.get(f"EXECUTOR_POOL_{name.upper()}", DEFAULT_POOLS.get(name, DEFAULT_POOLS["default"]))
+    workers, _, queue = spec.partition(":")
+    return max(1, int(workers)), max(0, int(queue or 0))
+
+
+class BoundedPool:
+    """A thread pool that admits at most `max_workers + max_queue` calls at once."""
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"terratale-{name}")
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+        self._max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        # `_submitted` counts only jobs that have not started yet
+        return self._submitted
+
+    async def run(self, func, *args, **kwargs):
+        with self._lock:
+            if self._submitted + self._active >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise PoolSaturatedError(f"Executor pool '{self.name}' is saturated.")
+            self._submitted += 1
+            self._max_queue_depth = max(self._max_queue_depth, self.queue_depth)
+
+        def call():
+            with self._lock:
+                self._submitted -= 1
+                self._active += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        def on_done(future):
+            # Jobs cancelled before they started never ran `call`, so release their slot here.
+            if future.cancelled():
+                with self._lock:
+                    self._submitted -= 1
+
+        future = self._executor.submit(call)
+        future.add_done_callback(on_done)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self._max_queue_depth,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name: str = "default") -> BoundedPool:
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            workers, queue = _pool_spec(name)
+            pool = _pools[name] = BoundedPool(name, workers, queue)
+        return pool
+
+
+async def run(pool_name: str, func, *args, **kwargs):
+    """Runs a blocking callable on the named pool without blocking the event loop."""
+    return await get_pool(pool_name).run(func, *args, **kwargs)
+
+
+def offload(pool_name: str = "default"):
+    """Decorator turning a blocking function into an awaitable that runs on `pool_name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run(pool_name, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats() -> dict:
+    """Per-pool queue depth and throughput counters."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.stats() for pool in pools}
+
+
+def shutdown():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
@@ -0,0 +1,304 @@
+"""
+Staged, resumable indexing pipeline for the Unsplash photos.
+
+    rows -> download (thread pool, pooled session) -> decode/resize (process pool)
+         -> CLIP batches -> streamed bulk indexing -> checkpoint
+
+Stages are connected by bounded queues, so a slow stage applies backpressure
+upstream instead of buffering the whole dataset in memory. Every indexed
+photo is recorded in a SQLite checkpoint, and a restarted run skips them.
+"""
+import csv
+import io
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --- Configuration ---
+PHOTOS_FILE = os.environ.get("UNSPLASH_PHOTOS_FILE", "data/unsplash/photos.tsv000")
+CHECKPOINT_FILE = os.environ.get("IMAGE_INDEX_CHECKPOINT", "data/unsplash/index_checkpoint.sqlite")
+DOWNLOAD_WORKERS = int(os.environ.get("IMAGE_DOWNLOAD_WORKERS", 32))
+DECODE_WORKERS = int(os.environ.get("IMAGE_DECODE_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+EMBED_BATCH_SIZE = int(os.environ.get("IMAGE_EMBED_BATCH_SIZE", 64))
+BULK_CHUNK_SIZE = int(os.environ.get("IMAGE_BULK_CHUNK_SIZE", 500))
+# Unsplash image URLs accept imgix resize parameters; CLIP only needs 224px.
+DOWNLOAD_WIDTH = int(os.environ.get("IMAGE_DOWNLOAD_WIDTH", 400))
+IMAGE_SIZE = 224
+QUEUE_DEPTH = 4  # Batches of headroom between stages
+_DONE = object()
+
+
+# --- Checkpointing ---
+class Checkpoint:
+    """Per-photo record of what has been indexed, safe to share across threads."""
+
+    def __init__(self, path: str = CHECKPOINT_FILE):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS indexed (photo_id TEXT PRIMARY KEY, indexed_at REAL)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def done_ids(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT photo_id FROM indexed")}
+
+    def mark(self, photo_ids: list):
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO indexed VALUES (?, ?)", [(p, now) for p in photo_ids])
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# --- Stage Metrics ---
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, count: int, seconds: float):
+        with self._lock:
+            self.count += count
+            self.busy_seconds += seconds
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self, elapsed: float) -> str:
+        rate = self.count / elapsed if elapsed else 0.0
+        return f"{self.name}: {self.count} ok, {self.errors} failed, {rate:.1f}/s"
+
+
+# --- Stage Workers ---
+def create_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """A pooled session with retries on transient HTTP errors."""
+    session = requests.Session()
+    retry = Retry(total=4, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def decode_and_resize(data: bytes, size: int = IMAGE_SIZE):
+    """Decodes an image and center-crops it to `size` x `size` RGB (runs in a worker process)."""
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (size, size))  # Lets JPEG decode at reduced scale
+    image = image.convert("RGB")
+    scale = size / min(image.size)
+    image = image.resize((max(size, round(image.width * scale)), max(size, round(image.height * scale))), Image.BICUBIC)
+    left, top = (image.width - size) // 2, (image.height - size) // 2
+    return np.asarray(image.crop((left, top, left + size, top + size)), dtype=np.uint8)
+
+
+def read_rows(path: str = PHOTOS_FILE, skip: set = frozenset(), limit: int = None):
+    """Streams photo rows from the dataset TSV, skipping already indexed ids."""
+    emitted = 0
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            if row["photo_id"] in skip:
+                continue
+            yield {
+                "photo_id": row["photo_id"],
+                "photo_image_url": row["photo_image_url"],
+                "photo_description": row.get("photo_description") or row.get("ai_description") or "",
+                # Placeholder label for now. User will replace this with actual labels.
+                "label": "",
+            }
+            emitted += 1
+            if limit and emitted >= limit:
+                return
+
+
+class ImageIndexingPipeline:
+    def __init__(self, sink, checkpoint: Checkpoint, download_workers: int = DOWNLOAD_WORKERS,
+                 decode_workers: int = DECODE_WORKERS, batch_size: int = EMBED_BATCH_SIZE):
+        self.sink = sink
+        self.checkpoint = checkpoint
+        self.download_workers = download_workers
+        self.decode_workers = decode_workers
+        self.batch_size = batch_size
+        self.stats = {name: StageStats(name) for name in ("download", "decode", "embed", "index")}
+        self._rows = queue.Queue(maxsize=download_workers * 2)
+        self._decoded = queue.Queue(maxsize=batch_size * QUEUE_DEPTH)
+        self._embedded = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._failed = threading.Event()
+        self.error = None
+
+    # Feeds rows; blocks when downloads fall behind
+    def _feed(self, rows):
+        try:
+            for row in rows:
+                if self._failed.is_set():
+                    break
+                self._rows.put(row)
+        finally:
+            for _ in range(self.download_workers):
+                self._rows.put(_DONE)
+
+    def _download_and_decode(self, session, decoder, remaining: list, remaining_lock):
+        try:
+            while True:
+                row = self._rows.get()
+                if row is _DONE:
+                    break
+                start = time.perf_counter()
+                try:
+                    response = session.get(row["photo_image_url"], params={"w": DOWNLOAD_WIDTH}, timeout=(5, 30))
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    self.stats["download"].error()
+                    print(f"Download failed for {row['photo_id']}: {e}")
+                    continue
+                self.stats["download"].add(1, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                try:
+                    pixels = decoder.submit(decode_and_resize, response.content).result()
+                except Exception as e:
+                    self.stats["decode"].error()
+                    print(f"Decode failed for {row['photo_id']}: {e}")
+                    continue
+                self.stats["decode"].add(1, time.perf_counter() - start)
+                self._decoded.put((row, pixels))
+        finally:
+            # The last downloader to finish closes the stream for the embed stage
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self._decoded.put(_DONE)
+
+    def _embed(self, encode_images):
+        batch, finished = [], False
+        while not finished:
+            item = self._decoded.get()
+            if item is _DONE:
+                finished = True
+            else:
+                batch.append(item)
+            if batch and (finished or len(batch) >= self.batch_size):
+                start = time.perf_counter()
+                try:
+                    vectors = encode_images([pixels for _, pixels in batch])
+                except Exception as e:
+                    print(f"Embedding failed for a batch of {len(batch)}: {e}")
+                    for _ in batch:
+                        self.stats["embed"].error()
+                else:
+                    self.stats["embed"].add(len(batch), time.perf_counter() - start)
+                    self._embedded.put([dict(row, image_embedding=vector) for (row, _), vector in zip(batch, vectors)])
+                batch = []
+        self._embedded.put(_DONE)
+
+    def _documents(self):
+        while True:
+            docs = self._embedded.get()
+            if docs is _DONE:
+                return
+            yield from docs
+
+    def _index(self):
+        try:
+            self._write_to_sink()
+        except Exception as e:
+            self.error = e
+            self._failed.set()
+
+    def _write_to_sink(self):
+        start = time.perf_counter()
+        pending = []
+        for photo_id, ok, error in self.sink.write(self._documents()):
+            if ok:
+                pending.append(photo_id)
+                self.stats["index"].add(1, 0.0)
+            else:
+                self.stats["index"].error()
+                print(f"Indexing failed for {photo_id}: {error}")
+            if len(pending) >= BULK_CHUNK_SIZE:
+                self.checkpoint.mark(pending)
+                pending = []
+        if pending:
+            self.checkpoint.mark(pending)
+        self.stats["index"].busy_seconds = time.perf_counter() - start
+
+    def report(self, elapsed: float):
+        print(" | ".join(stats.summary(elapsed) for stats in self.stats.values()))
+
+    def run(self, rows, encode_images, report_every: float = 10.0):
+        start = time.perf_counter()
+        session = create_session(self.download_workers)
+        remaining, remaining_lock = [self.download_workers], threading.Lock()
+        with ProcessPoolExecutor(max_workers=self.decode_workers) as decoder:
+            threads = [threading.Thread(target=self._feed, args=(rows,), name="feed", daemon=True)]
+            threads += [
+                threading.Thread(target=self._download_and_decode, args=(session, decoder, remaining, remaining_lock), name=f"download-{i}", daemon=True)
+                for i in range(self.download_workers)
+            ]
+            threads.append(threading.Thread(target=self._embed, args=(encode_images,), name="embed", daemon=True))
+            for thread in threads:
+                thread.start()
+
+            index_thread = threading.Thread(target=self._index, name="index", daemon=True)
+            index_thread.start()
+            try:
+                index_thread.join(report_every)
+                while index_thread.is_alive():
+                    self.report(time.perf_counter() - start)
+                    index_thread.join(report_every)
+            except KeyboardInterrupt:
+                # Stop feeding; everything already indexed is checkpointed
+                self._failed.set()
+                raise
+            finally:
+                session.close()
+        if self.error is not None:
+            raise RuntimeError(f"Image indexing stopped: {self.error}") from self.error
+        elapsed = time.perf_counter() - start
+        print(f"Image indexing finished in {elapsed:.1f}s")
+        self.report(elapsed)
+        return self.stats
+
+
+# --- Sinks ---
+class ElasticsearchSink:
+    """Streams documents into Elasticsearch; yields (photo_id, ok, error) per document."""
+
+    def __init__(self, es, index_name: str, chunk_size: int = BULK_CHUNK_SIZE):
+        self.es = es
+        self.index_name = index_name
+        self.chunk_size = chunk_size
+
+    def write(self, documents):
+        from elasticsearch.helpers import streaming_bulk
+
+        def actions():
+            for doc in documents:
+                yield {
+                    "_index": self.index_name,
+                    "_id": doc["photo_id"],
+                    "_source": dict(doc, image_embedding=[float(x) for x in doc["image_embedding"]]),
+                }
+
+        for ok, info in streaming_bulk(self.es, actions(), chunk_size=self.chunk_size, raise_on_error=False, max_retries=3):
+            result = next(iter(info.values()))
+            yield result.get("_id"), ok, result.get("error")
@@ -1,34 +1,74 @@
+"""
+CLIP-based image search over the Unsplash dataset.
+
+torch and transformers are imported lazily: the encoder for the configured
+CLIP_BACKEND is loaded by `load_model()` on first use (or by the startup
+warmup), not at import time. Photos are always embedded with
+CLIP_INDEX_BACKEND (fp32 torch by default), the reference that
+`clip_backends.parity_check()` validates query backends against.
+"""
 import os
+import threading
 import zipfile
-import pandas as pd
-import requests
-from PIL import Image
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import parallel_bulk
-from transformers import CLIPProcessor, CLIPModel
-import torch
-from huggingface_hub import login
-
-# Log in to Hugging Face Hub
-hf_token = os.environ.get("HUGGING_FACE_HUB_TOKEN") # Changed from HF_TOKEN
-if hf_token:
-    login(token=hf_token)
-    print("Successfully logged in to Hugging Face Hub.")
-else:
-    print("HUGGING_FACE_HUB_TOKEN not found in environment variables. Anonymous access to Hugging Face Hub.")
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+
+from . import clip_backends
+from . import clip_batcher
+from . import executor
+from . import image_pipeline
+from . import metrics
+from . import singleflight
+from . import vector_index
 
 # --- Configuration ---
 ELASTIC_API_KEY = os.environ.get("ELASTIC_API_KEY")
 ELASTIC_ENDPOINT_URL = os.environ.get("ELASTIC_ENDPOINT_URL")
 INDEX_NAME = "images"
 MODEL_NAME = "openai/clip-vit-base-patch32"
+# "local" (memory-mapped index), "elasticsearch", or "auto": local when a local index exists
+IMAGE_SEARCH_BACKEND = os.environ.get("IMAGE_SEARCH_BACKEND", "auto")
+CLIP_INDEX_BACKEND = os.environ.get("CLIP_INDEX_BACKEND", "torch")
 
 # --- Model Loading ---
-# Load the model and processor only once
-device = "cuda" if torch.cuda.is_available() else "cpu"
-hf_token = os.environ.get("HUGGING_FACE_HUB_TOKEN") # Read the token again, changed from HF_TOKEN
-model = CLIPModel.from_pretrained(MODEL_NAME, token=hf_token).to(device)
-processor = CLIPProcessor.from_pretrained(MODEL_NAME, token=hf_token)
+# The CLIP encoder for the configured backend (see clip_backends.py)
+encoder = None
+# The encoder photos are indexed with, when it differs from the query encoder
+index_encoder = None
+_model_lock = threading.Lock()
+
+def _hub_token():
+    from huggingface_hub import login
+
+    # Log in to Hugging Face Hub
+    hf_token = os.environ.get("HUGGING_FACE_HUB_TOKEN") # Changed from HF_TOKEN
+    if hf_token:
+        login(token=hf_token)
+        print("Successfully logged in to Hugging Face Hub.")
+    else:
+        print("HUGGING_FACE_HUB_TOKEN not found in environment variables. Anonymous access to Hugging Face Hub.")
+    return hf_token
+
+def load_model():
+    """Logs in to the Hugging Face Hub and loads the CLIP encoder only once."""
+    global encoder
+    if encoder is not None:
+        return encoder
+    with _model_lock:
+        if encoder is None:
+            encoder = clip_backends.load_encoder(MODEL_NAME, clip_backends.CLIP_BACKEND, token=_hub_token())
+    return encoder
+
+def load_index_model():
+    """The CLIP_INDEX_BACKEND encoder, reusing the query encoder when they are the same backend."""
+    global index_encoder
+    if CLIP_INDEX_BACKEND == clip_backends.CLIP_BACKEND:
+        return load_model()
+    if index_encoder is not None:
+        return index_encoder
+    with _model_lock:
+        if index_encoder is None:
+            index_encoder = clip_backends.load_encoder(MODEL_NAME, CLIP_INDEX_BACKEND, token=_hub_token())
+    return index_encoder
 
 # --- Elasticsearch Client ---
 def get_es_client():
@@ -37,9 +77,65 @@ def get_es_client():
     else:
         return None
 
+_async_es = None
+
+def get_async_es_client():
+    """Returns a shared AsyncElasticsearch client so searches reuse one connection pool."""
+    global _async_es
+    if not ELASTIC_ENDPOINT_URL:
+        return None
+    if _async_es is None:
+        _async_es = AsyncElasticsearch(ELASTIC_ENDPOINT_URL, api_key=ELASTIC_API_KEY, request_timeout=30)
+    return _async_es
+
+async def close_clients():
+    global _async_es
+    if _async_es is not None:
+        await _async_es.close()
+        _async_es = None
+
 # --- Indexing ---
-def index_images():
-    """Downloads the Unsplash dataset, generates embeddings, and indexes it into Elasticsearch."""
+def _search_backend() -> str:
+    if IMAGE_SEARCH_BACKEND != "auto":
+        return IMAGE_SEARCH_BACKEND
+    if vector_index.index_exists() or not ELASTIC_ENDPOINT_URL:
+        return "local"
+    return "elasticsearch"
+
+def download_dataset():
+    """Downloads and extracts the Unsplash Lite dataset if it is not already present."""
+    unsplash_zip_file = "unsplash-research-dataset-lite-1.2.0.zip"
+    if not os.path.exists(unsplash_zip_file):
+        os.system(f"curl -L https://unsplash.com/data/lite/1.2.0 -o {unsplash_zip_file}")
+    if not os.path.exists(image_pipeline.PHOTOS_FILE):
+        with zipfile.ZipFile(unsplash_zip_file, "r") as zip_ref:
+            zip_ref.extractall("data/unsplash/")
+
+def run_indexing_pipeline(sink, checkpoint_path: str, limit: int = None):
+    # Stream the photos through the download -> decode -> CLIP -> sink pipeline,
+    # skipping anything a previous run already indexed
+    checkpoint = image_pipeline.Checkpoint(checkpoint_path)
+    try:
+        done = checkpoint.done_ids()
+        if done:
+            print(f"Resuming image indexing; {len(done)} photos already indexed.")
+        pipeline = image_pipeline.ImageIndexingPipeline(sink, checkpoint)
+        pipeline.run(image_pipeline.read_rows(skip=done, limit=limit), encode_images)
+    finally:
+        checkpoint.close()
+
+def index_images_locally(limit: int = None):
+    """Builds the memory-mapped local index (see vector_index.py) from the Unsplash dataset."""
+    download_dataset()
+    writer = vector_index.LocalIndexWriter()
+    run_indexing_pipeline(writer, writer.checkpoint_path, limit)
+    writer.finalize()
+
+def index_images(limit: int = None):
+    """Downloads the Unsplash dataset, generates embeddings, and indexes them locally or into Elasticsearch."""
+    if _search_backend() == "local":
+        return index_images_locally(limit)
+
     es = get_es_client()
     if not es:
         print("Skipping image indexing because Elastic credentials are not set.")
@@ -75,62 +171,59 @@ def index_images():
         print(f"An error occurred while creating the index: {e}")
         return
 
-    # Download and extract the data
-    unsplash_zip_file = "unsplash-research-dataset-lite-1.2.0.zip"
-    if not os.path.exists(unsplash_zip_file):
-        os.system(f"curl -L https://unsplash.com/data/lite/1.2.0 -o {unsplash_zip_file}")
-        with zipfile.ZipFile(unsplash_zip_file, "r") as zip_ref:
-            zip_ref.extractall("data/unsplash/")
+    download_dataset()
+    run_indexing_pipeline(image_pipeline.ElasticsearchSink(es, INDEX_NAME), image_pipeline.CHECKPOINT_FILE, limit)
 
-    # Load the data
-    df_unsplash = pd.read_csv("data/unsplash/photos.tsv000", sep="\t", header=0)
-    df_unsplash.fillna("", inplace=True)
-    # Add a placeholder label column for now. User will replace this with actual labels.
-    df_unsplash["label"] = ""
-
-    # Generate embeddings and index in batches
-    batch_size = 50
-    for i in range(0, len(df_unsplash), batch_size):
-        batch_df = df_unsplash.iloc[i:i+batch_size]
-        images = [Image.open(requests.get(url, stream=True).raw) for url in batch_df["photo_image_url"]]
-        
-        inputs = processor(text=None, images=images, return_tensors="pt", padding=True)
-        with torch.no_grad():
-            image_features = model.get_image_features(pixel_values=inputs.pixel_values.to(device))
-        
-        actions = []
-        for j, row in enumerate(batch_df.iterrows()):
-            index, data = row
-            actions.append({
-                "_index": INDEX_NAME,
-                "_id": data["photo_id"],
-                "_source": {
-                    "photo_id": data["photo_id"],
-                    "photo_image_url": data["photo_image_url"],
-                    "photo_description": data["photo_description"],
-                    "label": data["label"],
-                    "image_embedding": image_features[j].cpu().numpy().tolist(),
-                }
-            })
-        
-        try:
-            parallel_bulk(client=es, actions=actions)
-            print(f"Indexed batch {i // batch_size + 1}")
-        except Exception as e:
-            print(f"An error occurred during indexing: {e}")
+def encode_images(images: list) -> list:
+    """Runs the CLIP_INDEX_BACKEND image encoder on a batch of 224x224 RGB arrays (blocking)."""
+    return list(load_index_model().encode_images(images))
 
 # --- Searching ---
-def search_images(query: str):
-    """Searches for images in Elasticsearch based on a text query."""
-    es = get_es_client()
-    if not es:
-        return {"error": "Elasticsearch credentials not configured."}
+def encode_texts(queries: list):
+    """Runs the CLIP text encoder on a batch of queries (blocking); returns an (n, dim) array."""
+    return load_model().encode_texts(queries)
 
-    inputs = processor(text=[query], padding=True, return_tensors="pt")
-    with torch.no_grad():
-        text_features = model.get_text_features(input_ids=inputs.input_ids.to(device), attention_mask=inputs.attention_mask.to(device))
+def encode_text(query: str) -> list:
+    """Runs the CLIP text encoder for a single query (blocking)."""
+    return encode_texts([query])[0].tolist()
 
-    query_embedding = text_features[0].cpu().numpy().tolist()
+# Concurrent searches share one forward pass per window
+text_batcher = clip_batcher.TextEncoderBatcher(encode_texts)
+
+_local_index = None
+
+def get_local_index():
+    """Opens the memory-mapped index once per process; the pages are shared between workers."""
+    global _local_index
+    if _local_index is None and vector_index.index_exists():
+        _local_index = vector_index.LocalVectorIndex()
+    return _local_index
+
+# Identical searches in flight at the same time share one encode and kNN call
+search_flights = singleflight.SingleFlight("image_search")
+
+async def search_images(query: str):
+    """Searches for images based on a text query, locally or in Elasticsearch."""
+    return await search_flights.do(singleflight.make_key(query), lambda: _search_images(query))
+
+async def _search_images(query: str):
+    backend = _search_backend()
+    if backend == "local":
+        index = get_local_index()
+        if index is None:
+            return {"error": "Local image index not built. Run `python -m backend.image_search`."}
+    else:
+        es = get_async_es_client()
+        if not es:
+            return {"error": "Elasticsearch credentials not configured."}
+
+    # Batched with concurrent queries and run on the bounded "clip" pool
+    query_embedding = (await text_batcher.encode(query)).tolist()
+
+    if backend == "local":
+        # A full scan takes milliseconds, so it runs on the executor like the other blocking work
+        with metrics.span("image_knn_local"):
+            return await executor.run("default", index.hits, query_embedding, k=5)
 
     knn_query = {
         "field": "image_embedding",
@@ -139,5 +232,11 @@ def search_images(query: str):
         "query_vector": query_embedding,
     }
 
-    response = es.search(index=INDEX_NAME, knn=knn_query, source=["photo_image_url", "photo_description", "label"])
+    with metrics.span("image_knn_elasticsearch"):
+        response = await es.search(index=INDEX_NAME, knn=knn_query, source=["photo_image_url", "photo_description", "label"])
     return response.body["hits"]["hits"]
+
+if __name__ == "__main__":
+    # python -m backend.image_search [limit]
+    import sys
+    index_images(limit=int(sys.argv[1]) if len(sys.argv) > 1 else None)
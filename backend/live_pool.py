@@ -0,0 +1,182 @@
+"""
+Warm, pooled Gemini Live sessions for Mateo.
+
+Opening a Live session costs a websocket handshake plus session setup before
+the first audio byte. The pool keeps a few fresh sessions connected ahead of
+demand, and each visitor's conversation leases one and keeps it across turns.
+A session is only ever reused by the conversation that leased it (it carries
+that conversation's history), and only while its last turn finished cleanly.
+A turn that other visitors joined keeps its session until it ends; if the
+conversation moves on first, it leases a fresh session and the old one is
+discarded once the shared turn is over. When connects fail, pre-connecting
+backs off exponentially until one succeeds again.
+"""
+import asyncio
+import os
+import time
+
+from . import metrics
+
+# --- Configuration ---
+LIVE_POOL_MIN_IDLE = int(os.environ.get("LIVE_POOL_MIN_IDLE", 2))
+LIVE_POOL_MAX_IDLE = int(os.environ.get("LIVE_POOL_MAX_IDLE", 4))
+# Live audio sessions are capped server-side; retire ours well before that.
+LIVE_SESSION_MAX_AGE_S = float(os.environ.get("LIVE_SESSION_MAX_AGE_S", 9 * 60))
+LIVE_POOL_IDLE_TIMEOUT_S = float(os.environ.get("LIVE_POOL_IDLE_TIMEOUT_S", 5 * 60))
+MAINTENANCE_INTERVAL_S = 5.0
+# Pre-connects pause after a failed connect, doubling per consecutive failure
+LIVE_POOL_RETRY_BASE_S = float(os.environ.get("LIVE_POOL_RETRY_BASE_S", 1.0))
+LIVE_POOL_RETRY_MAX_S = float(os.environ.get("LIVE_POOL_RETRY_MAX_S", 60.0))
+
+
+class LiveSession:
+    """An open Live session plus the context manager that owns it."""
+
+    def __init__(self, context_manager, session):
+        self._context_manager = context_manager
+        self.session = session
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.turns = 0
+        self.clean = True  # False once a turn was abandoned mid-stream
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+    def healthy(self, max_age: float = LIVE_SESSION_MAX_AGE_S) -> bool:
+        if not self.clean or self.age > max_age:
+            return False
+        ws = getattr(self.session, "_ws", None)
+        return getattr(ws, "close_code", None) is None
+
+    async def close(self):
+        try:
+            await self._context_manager.__aexit__(None, None, None)
+        except Exception as e:
+            print(f"Error closing Live session: {e}")
+
+
+class LiveSessionPool:
+    def __init__(self, connect, min_idle: int = LIVE_POOL_MIN_IDLE, max_idle: int = LIVE_POOL_MAX_IDLE,
+                 max_age: float = LIVE_SESSION_MAX_AGE_S, idle_timeout: float = LIVE_POOL_IDLE_TIMEOUT_S):
+        self.connect = connect  # () -> async context manager yielding a Live session
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._maintenance = None
+        self._refilling = 0
+        self._failures = 0  # Consecutive failed connects
+        self._retry_at = 0.0
+        self.counters = {
+            "connects": 0, "connect_failures": 0, "connect_seconds_total": 0.0,
+            "warm_hits": 0, "cold_starts": 0, "turns": 0, "reused_turns": 0,
+            "evictions": 0, "discards": 0,
+            "first_audio_seconds_total": 0.0, "first_audio_count": 0,
+        }
+
+    async def _open(self) -> LiveSession:
+        start = time.perf_counter()
+        context_manager = self.connect()
+        try:
+            session = await context_manager.__aenter__()
+        except Exception:
+            self.counters["connect_failures"] += 1
+            self._failures += 1
+            backoff = min(LIVE_POOL_RETRY_BASE_S * 2 ** (self._failures - 1), LIVE_POOL_RETRY_MAX_S)
+            self._retry_at = time.monotonic() + backoff
+            raise
+        self._failures, self._retry_at = 0, 0.0
+        elapsed = time.perf_counter() - start
+        self.counters["connects"] += 1
+        self.counters["connect_seconds_total"] += elapsed
+        metrics.observe("live_connect", elapsed)
+        return LiveSession(context_manager, session)
+
+    async def acquire(self) -> LiveSession:
+        """Returns a fresh, healthy session: a warm one if available, otherwise a new connection."""
+        while self._idle:
+            live = self._idle.pop()
+            if live.healthy(self.max_age):
+                self.counters["warm_hits"] += 1
+                self._schedule_refill()
+                return live
+            self.counters["evictions"] += 1
+            asyncio.create_task(live.close())
+        self.counters["cold_starts"] += 1
+        self._schedule_refill()
+        return await self._open()
+
+    async def discard(self, live: LiveSession):
+        self.counters["discards"] += 1
+        await live.close()
+
+    def record_turn(self, reused: bool, first_audio_seconds: float = None):
+        self.counters["turns"] += 1
+        if reused:
+            self.counters["reused_turns"] += 1
+        if first_audio_seconds is not None:
+            self.counters["first_audio_seconds_total"] += first_audio_seconds
+            self.counters["first_audio_count"] += 1
+
+    # --- Maintenance ---
+    def _schedule_refill(self):
+        if time.monotonic() < self._retry_at:
+            return  # Backing off after failed connects; maintenance retries later
+        missing = self.min_idle - len(self._idle) - self._refilling
+        for _ in range(max(0, missing)):
+            self._refilling += 1
+            asyncio.create_task(self._refill_one())
+
+    async def _refill_one(self):
+        try:
+            live = await self._open()
+        except Exception as e:
+            print(f"Could not pre-connect a Live session: {e}")
+            return
+        finally:
+            self._refilling -= 1
+        if len(self._idle) < self.max_idle:
+            self._idle.append(live)
+        else:
+            await live.close()
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL_S)
+            now = time.monotonic()
+            keep = []
+            for live in self._idle:
+                if live.healthy(self.max_age) and now - live.last_used <= self.idle_timeout:
+                    keep.append(live)
+                else:
+                    self.counters["evictions"] += 1
+                    asyncio.create_task(live.close())
+            self._idle = keep
+            self._schedule_refill()
+
+    def start(self):
+        if self._maintenance is None:
+            self._schedule_refill()
+            self._maintenance = asyncio.create_task(self._maintain())
+
+    async def close(self):
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            self._maintenance = None
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(live.close() for live in idle), return_exceptions=True)
+
+    def stats(self) -> dict:
+        counters = self.counters
+        return {
+            **counters,
+            "idle": len(self._idle),
+            "refill_backoff_seconds": max(0.0, self._retry_at - time.monotonic()),
+            "mean_connect_seconds": counters["connect_seconds_total"] / counters["connects"] if counters["connects"] else 0.0,
+            "mean_first_audio_seconds": (
+                counters["first_audio_seconds_total"] / counters["first_audio_count"] if counters["first_audio_count"] else 0.0
+            ),
+        }
@@ -1,10 +1,9 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from pydantic import BaseModel
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 import asyncio
-import io
 import os
 import json
 from dotenv import load_dotenv
@@ -12,8 +11,15 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from . import ai_core
-from . import qa_system
-from . import image_search
+from . import answer_pack
+from . import audio_transport
+from . import config
+from . import executor
+from . import metrics
+from . import query_embedding
+from . import response_cache
+from . import subsystems
+from . import tts_cache
 
 # --- App Setup ---
 app = FastAPI(title="Dual Response AI Assistant")
@@ -27,11 +33,25 @@ app.add_middleware(
 )
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     # Load and index documents on startup
     # qa_system.load_and_index_docs() # Disabled for now
     # image_search.index_images() # Disabled for now
-    pass
+    # Retrieval, QA and CLIP load lazily; warm them now or in the background (FAST_START)
+    await subsystems.start()
+    # Memory-map the precomputed tour answers so the first known question is served from them
+    await executor.run("default", answer_pack.get_pack)
+    if ai_core.client:
+        # Pre-connect Live sessions so Mateo's first answer skips the handshake
+        ai_core.live_sessions.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    image_search = subsystems.get("image_search")
+    if image_search.loaded:
+        await image_search.module.close_clients()
+    await ai_core.live_sessions.close()
+    executor.shutdown()
 
 # --- API Models ---
 class SynthesizeRequest(BaseModel):
@@ -44,51 +64,256 @@ class ImageSearchRequest(BaseModel):
     query: str
 
 # --- Endpoints ---
+async def send_papito_response(websocket: WebSocket, query: str, context: list):
+    """Generates Papito's text answer and sends it tagged with its persona."""
+    try:
+        if config.TEXT_STREAMING:
+            parts = []
+            async for delta in ai_core.stream_text_response(query, context):
+                parts.append(delta)
+                await websocket.send_text(json.dumps({"type": "text_delta", "persona": "papito", "content": delta}))
+            await websocket.send_text(json.dumps({"type": "text_end", "persona": "papito", "content": "".join(parts)}))
+        else:
+            text_response = await ai_core.generate_text_response(query, context)
+            await websocket.send_text(json.dumps({"type": "text", "persona": "papito", "content": text_response}))
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        print(f"Error during text generation: {e}")
+        await websocket.send_text(json.dumps({"type": "error", "persona": "papito", "content": str(e)}))
+
+async def send_mateo_response(websocket: WebSocket, query: str, context: list, audio_session):
+    """Streams Mateo's audio answer; the session tags its own messages."""
+    await audio_session.generate_and_stream_audio(query, context, websocket)
+
+async def answer_query(websocket: WebSocket, query: str, audio_session):
+    """Runs one turn: retrieval, then both personas, or a replay from the answer pack or semantic cache."""
+    packed = answer_pack.lookup(query)
+    if packed is not None:
+        print(f"Answer pack hit for: {query}")
+        await answer_pack.replay(websocket, packed)
+        return
+
+    # One retrieval per turn, shared by both personas
+    context = await ai_core.search_knowledge_base(query)
+    embedding = await query_embedding.aembed(query)
+
+    # A paraphrase of a packed question only counts if it retrieves the same context
+    packed = answer_pack.lookup_similar(query, context, embedding)
+    if packed is not None:
+        print(f"Answer pack paraphrase hit for: {query}")
+        await answer_pack.replay(websocket, packed)
+        return
+
+    if response_cache.SEMANTIC_CACHE_ENABLED:
+        cached = response_cache.cache.lookup(query, context, embedding)
+        if cached is not None:
+            print(f"Semantic cache hit for: {query}")
+            await response_cache.replay(websocket, cached)
+            return
+        websocket = recorder = response_cache.ResponseRecorder(websocket)
+
+    # Run Papito (text) and Mateo (audio) concurrently so neither waits on the other
+    tasks = [
+        asyncio.create_task(send_papito_response(websocket, query, context)),
+        asyncio.create_task(send_mateo_response(websocket, query, context, audio_session)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if response_cache.SEMANTIC_CACHE_ENABLED and not recorder.failed:
+        response_cache.cache.store(query, context, recorder.messages, embedding)
+
+def is_cancel_message(message: str) -> bool:
+    if not message.startswith("{"):
+        return False
+    try:
+        return json.loads(message).get("type") == "cancel"
+    except (ValueError, AttributeError):
+        return False
+
+async def answer_queries(stream, pending: asyncio.Queue, audio_session, turn: dict):
+    """Answers queued queries one at a time; `turn["task"]` is the cancellable current answer."""
+    while True:
+        query = await pending.get()
+        task = turn["task"] = asyncio.create_task(answer_query(stream, query, audio_session))
+        try:
+            await asyncio.wait({task})
+        finally:
+            # Only reached by cancellation when the connection itself is closing
+            task.cancel()
+            turn["task"] = None
+        if task.cancelled():
+            # Drop anything the answer queued while it was unwinding
+            stream.clear_audio()
+            stream.clear_papito()
+            print(f"Cancelled answer to: {query}")
+        elif task.exception() is not None:
+            print(f"Error answering query: {task.exception()}")
+            await stream.send_text(json.dumps({"type": "error", "content": str(task.exception())}))
+
+def interrupt(stream, turn: dict) -> bool:
+    """Aborts the answer in progress, upstream calls and queued audio included."""
+    task = turn["task"]
+    if task is None or task.done():
+        return False
+    task.cancel()
+    stream.clear_audio()
+    stream.clear_papito()
+    return True
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     print("Websocket connected")
+    # Outgoing messages go through a framed, bounded queue; the client lists the codecs it can decode
+    stream = audio_transport.AudioStream(websocket, websocket.query_params.get("codecs", "pcm").split(","))
+    # Mateo keeps one Live session for the whole conversation
+    audio_session = ai_core.MateoAudioSession(stream)
+    # Reading and answering run concurrently, so a new question or `cancel` can interrupt an answer
+    pending = asyncio.Queue(maxsize=config.MAX_PENDING_QUERIES)
+    turn = {"task": None}
+    worker = asyncio.create_task(answer_queries(stream, pending, audio_session, turn))
+    metrics.active_websockets.inc()
     try:
         while True:
-            query = await websocket.receive_text()
-            print(f"Received query: {query}")
+            message = await websocket.receive_text()
 
-            # Generate and send the text response
-            text_response = ai_core.generate_text_response(query, ai_core.search_knowledge_base(query))
-            await websocket.send_text(json.dumps({"type": "text", "content": text_response}))
+            if is_cancel_message(message):
+                while not pending.empty():
+                    pending.get_nowait()
+                if interrupt(stream, turn):
+                    await stream.send_text(json.dumps({"type": "cancelled"}))
+                continue
 
-            # Generate and stream the audio response
-            audio_session = ai_core.MateoAudioSession(websocket)
-            await audio_session.generate_and_stream_audio(query, ai_core.search_knowledge_base(query))
+            print(f"Received query: {message}")
+            if pending.full():
+                await stream.send_text(json.dumps({"type": "error", "content": "Too many pending questions; please wait."}))
+                continue
+            # Barge-in: a new question supersedes the answer in progress
+            if config.BARGE_IN and interrupt(stream, turn):
+                await stream.send_text(json.dumps({"type": "cancelled"}))
+            pending.put_nowait(message)
 
     except WebSocketDisconnect:
         print("Client disconnected.")
+    finally:
+        metrics.active_websockets.dec()
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await audio_session.close()
+        await stream.close()
+
+def audio_response(request: Request, key: str, audio: bytes, media_type: str = "audio/mpeg") -> Response:
+    """Serves cached audio with ETag revalidation and single-range requests."""
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=86400"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header and range_header.startswith("bytes="):
+        start_str, _, end_str = range_header[len("bytes="):].split(",")[0].strip().partition("-")
+        size = len(audio)
+        try:
+            if start_str:
+                start, end = int(start_str), int(end_str) if end_str else size - 1
+            else:
+                start, end = max(0, size - int(end_str)), size - 1
+        except ValueError:
+            start, end = size, size
+        if start >= size or start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        end = min(end, size - 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return Response(content=audio[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+    return Response(content=audio, media_type=media_type, headers=headers)
 
 @app.post("/synthesize")
-async def synthesize_text(request: SynthesizeRequest):
+async def synthesize_text(request: SynthesizeRequest, http_request: Request):
     try:
-        audio_bytes = ai_core.synthesize_papito_speech(request.text)
-        return StreamingResponse(io.BytesIO(audio_bytes), media_type="audio/mpeg")
+        key, audio_bytes = await ai_core.get_papito_speech(request.text)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    response = audio_response(http_request, key, audio_bytes)
+    response.headers["Content-Location"] = f"/audio/{key}"
+    return response
+
+@app.get("/audio/{key}")
+async def cached_audio(key: str, request: Request):
+    audio_bytes = await tts_cache.cache.get(key) if len(key) == 64 and key.isalnum() else None
+    if audio_bytes is None:
+        raise HTTPException(status_code=404, detail="Audio not found.")
+    return audio_response(request, key, audio_bytes)
 
 @app.post("/qa")
 async def qa_endpoint(request: QARequest):
     try:
-        qa_chain = qa_system.create_qa_chain()
-        answer = qa_chain.invoke(request.question)
+        qa_system = await subsystems.aload("qa")
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"QA is unavailable: {e}")
+    try:
+        answer = await qa_system.service.ainvoke(request.question)
         return {"answer": answer}
+    except qa_system.QANotConfiguredError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/image-search")
 async def image_search_endpoint(request: ImageSearchRequest):
     try:
-        results = image_search.search_images(request.query)
+        image_search = await subsystems.aload("image_search")
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Image search is unavailable: {e}")
+    try:
+        results = await image_search.search_images(request.query)
         return {"results": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and the event loop is responsive."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: chat can be served once the required subsystems are loaded."""
+    ready, statuses = subsystems.readiness()
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "subsystems": statuses})
+
+def collect_stats() -> dict:
+    stats = {
+        "executor": executor.stats(),
+        "tts_cache": tts_cache.cache.stats(),
+        "response_cache": response_cache.cache.stats(),
+        "answer_pack": answer_pack.stats(),
+        "coalescing": {
+            "papito_text": ai_core.text_flights.stats(), "mateo_audio": ai_core.audio_flights.stats(),
+            "papito_speech": ai_core.speech_flights.stats(),
+        },
+        "live_sessions": ai_core.live_sessions.stats(),
+        "audio_transport": audio_transport.stats(),
+    }
+    image_search = subsystems.get("image_search")
+    if image_search.loaded:
+        stats["clip_text_batcher"] = image_search.module.text_batcher.stats()
+    return stats
+
+@app.get("/stats")
+async def stats_endpoint():
+    return collect_stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus exposition: stage latency histograms plus every /stats counter as a gauge."""
+    return PlainTextResponse(metrics.render(collect_stats()), media_type="text/plain; version=0.0.4")
+
 # --- Static Files ---
 frontend_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "frontend"))
 app.mount("/", StaticFiles(directory=frontend_dir, html=True), name="static")
@@ -0,0 +1,178 @@
+"""
+Stage latency histograms, gauges and an optional OpenTelemetry tracer.
+
+`span("retrieval")` times a block into `terratale_stage_seconds{stage=...}`
+and, when OTEL_TRACES_EXPORTER is set ("gcp" or "console"), also records it
+as a trace span. Stages measured by hand (time to first token or audio) use
+`observe()`. `render()` writes the Prometheus text exposition format that
+`/metrics` serves; the counters behind `/stats` are folded in as gauges.
+"""
+import contextlib
+import math
+import os
+import threading
+import time
+
+# --- Configuration ---
+OTEL_TRACES_EXPORTER = os.environ.get("OTEL_TRACES_EXPORTER", "none")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_name: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label: str, value: float):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label: list(values) for label, values in self._series.items()}
+        for label, values in sorted(series.items()):
+            for bound, count in zip(self.buckets + (math.inf,), values[:len(self.buckets)] + [values[-2]]):
+                labels = _format_labels({self.label_name: label, "le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels({self.label_name: label})
+            lines.append(f"{self.name}_count{labels} {values[-2]}")
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-1])}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_format_value(self.value)}"]
+
+
+stage_seconds = Histogram("terratale_stage_seconds", "Latency of each request stage.", "stage")
+active_websockets = Gauge("terratale_active_websockets", "Open /ws connections.")
+_registry = [stage_seconds, active_websockets]
+
+
+def register(metric):
+    """Adds a module's own histogram or gauge to the /metrics output."""
+    _registry.append(metric)
+    return metric
+
+# --- Tracing ---
+_tracer = None
+
+
+def _init_tracer():
+    global _tracer
+    if OTEL_TRACES_EXPORTER in ("", "none"):
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if OTEL_TRACES_EXPORTER == "gcp":
+            from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+            exporter = CloudTraceSpanExporter()
+        else:
+            exporter = ConsoleSpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+        _tracer = trace.get_tracer("terratale")
+        print(f"OpenTelemetry tracing enabled ({OTEL_TRACES_EXPORTER}).")
+    except Exception as e:
+        print(f"OpenTelemetry tracing disabled: {e}")
+
+
+_init_tracer()
+
+
+def observe(stage: str, seconds: float):
+    stage_seconds.observe(stage, seconds)
+
+
+@contextlib.contextmanager
+def span(stage: str, **attributes):
+    """Times the enclosed block as `stage`; works inside coroutines as well."""
+    start = time.perf_counter()
+    if _tracer is None:
+        try:
+            yield
+        finally:
+            observe(stage, time.perf_counter() - start)
+        return
+    with _tracer.start_as_current_span(stage, attributes=attributes):
+        try:
+            yield
+        finally:
+            observe(stage, time.perf_counter() - start)
+
+
+# --- Exposition ---
+def _metric_name(*parts) -> str:
+    return "_".join(str(part) for part in parts).replace("-", "_").replace(".", "_")
+
+
+def _flatten_stats(prefix: str, stats: dict, labels: dict, families: dict):
+    """Numeric leaves become gauges; a dict of dicts (e.g. one per pool) becomes a `name` label."""
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            families.setdefault(_metric_name(prefix, key), []).append((labels, value))
+        elif isinstance(value, dict):
+            if value and all(isinstance(v, dict) for v in value.values()):
+                for name, inner in value.items():
+                    _flatten_stats(_metric_name(prefix, key), inner, {**labels, "name": name}, families)
+            else:
+                _flatten_stats(_metric_name(prefix, key), value, labels, families)
+
+
+def render(stats: dict = None) -> str:
+    """Prometheus text format; `stats` is the /stats document, one section per component."""
+    lines = [line for metric in _registry for line in metric.render()]
+    families = {}
+    _flatten_stats("terratale", stats or {}, {}, families)
+    for name, samples in families.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
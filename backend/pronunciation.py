@@ -0,0 +1,95 @@
+"""
+Pronunciation dictionary compiled into a single matcher for SSML generation.
+
+The dictionary is loaded once and reloaded only when pronunciations.json
+changes. All entries are compiled into one trie-shaped regex, so the text is
+scanned in a single pass regardless of dictionary size, with longest-match
+and whole-word semantics, and everything outside the tags is XML-escaped.
+"""
+import json
+import os
+import re
+import threading
+from xml.sax.saxutils import escape, quoteattr
+
+# --- Configuration ---
+PRONUNCIATION_FILE = os.environ.get(
+    "PRONUNCIATION_FILE", os.path.join(os.path.dirname(__file__), "pronunciations.json")
+)
+PHONETIC_ALPHABET = "x-ipa"
+
+
+def _trie_pattern(node: dict) -> str:
+    """Turns a character trie into a regex; `?` is greedy, so longer words win."""
+    alternatives = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    if not alternatives:
+        return ""
+    body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+    if "" in node:
+        body = f"(?:{body})?"
+    return body
+
+
+def compile_matcher(words):
+    """Compiles dictionary words into one case-insensitive, whole-word regex."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word.lower():
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    if not trie:
+        return None
+    return re.compile(r"(?<!\w)" + _trie_pattern(trie) + r"(?!\w)", re.IGNORECASE)
+
+
+class PronunciationEngine:
+    def __init__(self, path: str = PRONUNCIATION_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._lookup = {}
+        self._matcher = None
+
+    def _reload_if_changed(self):
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            entries = {}
+            if signature is not None:
+                with open(self.path, "r") as f:
+                    entries = json.load(f)
+            self._lookup = {word.lower(): ph for word, ph in entries.items()}
+            self._matcher = compile_matcher(entries)
+            self._signature = signature
+            print(f"Loaded {len(entries)} pronunciations.")
+
+    def to_ssml(self, text: str) -> str:
+        """Builds the <speak> document for `text` in a single pass."""
+        self._reload_if_changed()
+        matcher, lookup = self._matcher, self._lookup
+        if matcher is None:
+            return f"<speak>{escape(text)}</speak>"
+
+        parts = ["<speak>"]
+        position = 0
+        for match in matcher.finditer(text):
+            word = match.group(0)
+            parts.append(escape(text[position:match.start()]))
+            parts.append(
+                f"<phoneme alphabet={quoteattr(PHONETIC_ALPHABET)} ph={quoteattr(lookup[word.lower()])}>{escape(word)}</phoneme>"
+            )
+            position = match.end()
+        parts.append(escape(text[position:]))
+        parts.append("</speak>")
+        return "".join(parts)
+
+
+engine = PronunciationEngine()
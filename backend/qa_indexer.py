@@ -0,0 +1,204 @@
+"""
+Incremental indexing of the QA corpus into Elasticsearch.
+
+Documents are split into token-sized chunks and each chunk is stored under
+a content hash of (document, text, embedding model). A run compares those
+ids with what the index already holds. It embeds only the new chunks, in
+batches of up to QA_EMBED_BATCH texts with QA_EMBED_CONCURRENCY requests in
+flight, and deletes chunks whose document changed or disappeared. Editing one
+document therefore costs one embedding batch.
+
+    python -m backend.qa_indexer [corpus.json]
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+# --- Configuration ---
+QA_CORPUS_PATH = os.environ.get("QA_CORPUS_PATH", os.path.join(os.path.dirname(__file__), "data.json"))
+QA_CHUNK_TOKENS = int(os.environ.get("QA_CHUNK_TOKENS", 256))
+QA_CHUNK_OVERLAP_TOKENS = int(os.environ.get("QA_CHUNK_OVERLAP_TOKENS", 32))
+# The embedding API accepts at most 100 texts per batch request
+QA_EMBED_BATCH = min(100, int(os.environ.get("QA_EMBED_BATCH", 100)))
+QA_EMBED_CONCURRENCY = int(os.environ.get("QA_EMBED_CONCURRENCY", 4))
+QA_EMBED_RETRIES = 4
+METADATA_FIELDS = ("name", "summary", "url", "category", "rolePermissions", "updated_at")
+
+# Word pieces and punctuation; close to subword token counts for English prose
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(_PIECE_RE.findall(text))
+
+
+@dataclass
+class Chunk:
+    id: str
+    text: str
+    metadata: dict = field(default_factory=dict)
+
+
+def _hard_split(text: str, max_tokens: int) -> list:
+    """Cuts text with no usable sentence break into pieces of at most `max_tokens` tokens."""
+    starts = [match.start() for match in _PIECE_RE.finditer(text)][::max_tokens]
+    bounds = starts[1:] + [len(text)]
+    return [text[start:end].strip() for start, end in zip(starts, bounds) if text[start:end].strip()]
+
+
+def _units(content: str, max_tokens: int = QA_CHUNK_TOKENS) -> list:
+    """Paragraphs, with any paragraph over the chunk budget broken into sentences, and any
+    sentence still over it cut by token count."""
+    units = []
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            units.append(paragraph)
+            continue
+        for sentence in _SENTENCE_RE.split(paragraph):
+            if not sentence.strip():
+                continue
+            if estimate_tokens(sentence) <= max_tokens:
+                units.append(sentence)
+            else:
+                units.extend(_hard_split(sentence, max_tokens))
+    return units
+
+
+def split_document(content: str, max_tokens: int = QA_CHUNK_TOKENS, overlap_tokens: int = QA_CHUNK_OVERLAP_TOKENS) -> list:
+    """Packs paragraphs (or sentences) into chunks of at most `max_tokens`, carrying a short tail over."""
+    chunks, current, tokens = [], [], 0
+    for unit in _units(content, max_tokens):
+        n = estimate_tokens(unit)
+        if current and tokens + n > max_tokens:
+            chunks.append("\n".join(current))
+            # Repeat the last unit in the next chunk when it is short, so no fact is cut in half
+            tail, tail_tokens = current[-1], estimate_tokens(current[-1])
+            keep_tail = tail_tokens <= overlap_tokens and tail_tokens + n <= max_tokens
+            current, tokens = ([tail], tail_tokens) if keep_tail else ([], 0)
+        current.append(unit)
+        tokens += n
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def chunk_id(doc_name: str, text: str, model: str) -> str:
+    digest = hashlib.sha256()
+    for part in (model, doc_name, text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:40]
+
+
+def build_chunks(docs: list, model: str) -> list:
+    chunks = {}
+    for doc in docs:
+        metadata = {key: doc[key] for key in METADATA_FIELDS if key in doc}
+        for position, text in enumerate(split_document(doc["content"])):
+            cid = chunk_id(doc["name"], text, model)
+            chunks[cid] = Chunk(cid, text, {**metadata, "chunk": position, "content_hash": cid})
+    return list(chunks.values())
+
+
+@dataclass
+class IndexPlan:
+    add: list  # Chunks to embed and index
+    delete: list  # Ids no longer produced by the corpus
+    unchanged: int
+
+
+def plan(chunks: list, existing_ids: set) -> IndexPlan:
+    current = {chunk.id for chunk in chunks}
+    return IndexPlan(
+        add=[chunk for chunk in chunks if chunk.id not in existing_ids],
+        delete=sorted(existing_ids - current),
+        unchanged=len(current & existing_ids),
+    )
+
+
+# --- Elasticsearch ---
+def existing_chunk_ids(es, index_name: str) -> set:
+    from elasticsearch import helpers
+
+    if not es.indices.exists(index=index_name):
+        return set()
+    return {hit["_id"] for hit in helpers.scan(es, index=index_name, query={"query": {"match_all": {}}}, _source=False)}
+
+
+def _embed_with_retries(embeddings, texts: list) -> list:
+    for attempt in range(QA_EMBED_RETRIES):
+        try:
+            return embeddings.embed_documents(texts, batch_size=len(texts))
+        except Exception as e:
+            if attempt == QA_EMBED_RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            print(f"Embedding batch failed ({e}); retrying in {delay}s.")
+            time.sleep(delay)
+
+
+def index_chunks(store, embeddings, chunks: list, batch_size: int = QA_EMBED_BATCH,
+                 concurrency: int = QA_EMBED_CONCURRENCY) -> int:
+    """Embeds and writes `chunks` batch by batch; finished batches stay indexed if a later one fails."""
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="terratale-qa-embed") as pool:
+        futures = {pool.submit(_embed_with_retries, embeddings, [c.text for c in batch]): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            store.add_embeddings(
+                text_embeddings=list(zip((c.text for c in batch), future.result())),
+                metadatas=[c.metadata for c in batch],
+                ids=[c.id for c in batch],
+            )
+    return len(batches)
+
+
+def load_documents(path: str = QA_CORPUS_PATH) -> list:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def run(path: str = QA_CORPUS_PATH) -> dict:
+    """Brings the QA index in line with the corpus file; returns what changed."""
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    from . import qa_system
+
+    service = qa_system.service
+    store = service.vector_store()
+    if store is None:
+        print("Skipping QA document indexing because Elastic credentials are not set.")
+        return {}
+
+    start = time.perf_counter()
+    chunks = build_chunks(load_documents(path), qa_system.QA_EMBEDDING_MODEL)
+    changes = plan(chunks, existing_chunk_ids(service.es_client(), qa_system.elastic_index_name))
+    print(f"QA index: {len(chunks)} chunks, {changes.unchanged} unchanged, {len(changes.add)} to embed, {len(changes.delete)} to delete.")
+
+    batches = 0
+    if changes.add:
+        embeddings = GoogleGenerativeAIEmbeddings(model=qa_system.QA_EMBEDDING_MODEL, task_type="retrieval_document")
+        batches = index_chunks(store, embeddings, changes.add)
+    # Delete after adding, so an edited document is never missing from the index
+    if changes.delete:
+        store.delete(ids=changes.delete, refresh_indices=True)
+
+    summary = {
+        "chunks": len(chunks), "unchanged": changes.unchanged, "embedded": len(changes.add),
+        "deleted": len(changes.delete), "embedding_batches": batches, "seconds": round(time.perf_counter() - start, 2),
+    }
+    print(f"QA index up to date: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    import sys
+    run(sys.argv[1] if len(sys.argv) > 1 else QA_CORPUS_PATH)
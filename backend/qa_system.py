@@ -1,15 +1,19 @@
 import json
 import os
+import threading
 from urllib.request import urlopen
 
+from elasticsearch import Elasticsearch
 from langchain_elasticsearch import ElasticsearchStore
-from langchain.text_splitter import CharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.runnable import RunnablePassthrough
 
+from . import executor
+from . import metrics
+
 # --- Configuration ---
 ELASTIC_API_KEY = os.environ.get("ELASTIC_API_KEY")
 ELASTIC_CLOUD_ID = os.environ.get("ELASTIC_CLOUD_ID")
@@ -18,72 +22,55 @@ elastic_index_name = "gemini-qa"
 
 # --- Document Loading and Indexing ---
 def load_and_index_docs():
-    """Loads data, splits it into documents, and indexes it in Elasticsearch."""
-    if not ELASTIC_API_KEY or (not ELASTIC_CLOUD_ID and not ELASTIC_ENDPOINT_URL):
-        print("Skipping QA document indexing because Elastic credentials are not set.")
-        return
-
-    # Load documents from a local JSON file
-    file_path = os.path.join(os.path.dirname(__file__), "data.json")
-    with open(file_path, 'r') as f:
-        workplace_docs = json.load(f)
-
-    # Split documents into passages
-    metadata = []
-    content = []
-    for doc in workplace_docs:
-        content.append(doc["content"])
-        metadata.append(
-            {
-                "name": doc["name"],
-                "summary": doc["summary"],
-                "rolePermissions": doc["rolePermissions"],
-            }
-        )
-
-    text_splitter = CharacterTextSplitter(chunk_size=50, chunk_overlap=0)
-    docs = text_splitter.create_documents(content, metadatas=metadata)
-
-    # Index documents into Elasticsearch
-    query_embedding = GoogleGenerativeAIEmbeddings(
-        model="models/embedding-001", task_type="retrieval_document"
-    )
-
-    if ELASTIC_ENDPOINT_URL:
-        es_connection_args = {"es_url": ELASTIC_ENDPOINT_URL, "es_api_key": ELASTIC_API_KEY}
-    else:
-        es_connection_args = {"es_cloud_id": ELASTIC_CLOUD_ID, "es_api_key": ELASTIC_API_KEY}
+    """Brings the Elasticsearch index in line with data.json, embedding only changed chunks."""
+    from . import qa_indexer
+    return qa_indexer.run()
 
-    es = ElasticsearchStore.from_documents(
-        docs,
-        **es_connection_args,
-        index_name=elastic_index_name,
-        embedding=query_embedding,
+# --- QA Chain ---
+QA_TOP_K = 3
+QA_CHAT_MODEL = "gemini-pro"
+QA_EMBEDDING_MODEL = "models/embedding-001"
+QA_CONNECTIONS_PER_NODE = int(os.environ.get("QA_CONNECTIONS_PER_NODE", 10))
+
+def _elastic_settings() -> tuple:
+    """Current Elastic settings, read fresh so a changed environment triggers a rebuild."""
+    return (
+        os.environ.get("ELASTIC_API_KEY"),
+        os.environ.get("ELASTIC_CLOUD_ID"),
+        os.environ.get("ELASTIC_ENDPOINT_URL"),
     )
-    return es
 
-# --- QA Chain ---
-def create_qa_chain():
-    """Creates a question-answering chain using Elasticsearch and Gemini."""
-    if not ELASTIC_API_KEY or (not ELASTIC_CLOUD_ID and not ELASTIC_ENDPOINT_URL):
+def create_vector_store(es_connection=None):
+    """Connects to the Elasticsearch vector store holding the QA passages."""
+    api_key, cloud_id, endpoint_url = _elastic_settings()
+    if not api_key or (not cloud_id and not endpoint_url):
         return None
 
     query_embedding = GoogleGenerativeAIEmbeddings(
-        model="models/embedding-001", task_type="retrieval_query"
+        model=QA_EMBEDDING_MODEL, task_type="retrieval_query"
     )
 
-    if ELASTIC_ENDPOINT_URL:
-        es_connection_args = {"es_url": ELASTIC_ENDPOINT_URL, "es_api_key": ELASTIC_API_KEY}
+    if es_connection is not None:
+        es_connection_args = {"es_connection": es_connection}
+    elif endpoint_url:
+        es_connection_args = {"es_url": endpoint_url, "es_api_key": api_key}
     else:
-        es_connection_args = {"es_cloud_id": ELASTIC_CLOUD_ID, "es_api_key": ELASTIC_API_KEY}
+        es_connection_args = {"es_cloud_id": cloud_id, "es_api_key": api_key}
 
     es = ElasticsearchStore(
         **es_connection_args,
         embedding=query_embedding,
         index_name=elastic_index_name,
     )
+    return es
 
-    retriever = es.as_retriever(search_kwargs={"k": 3})
+def create_qa_chain(vector_store=None):
+    """Creates a question-answering chain using Elasticsearch and Gemini."""
+    es = vector_store or create_vector_store()
+    if es is None:
+        return None
+
+    retriever = es.as_retriever(search_kwargs={"k": QA_TOP_K})
 
     def format_docs(docs):
         return "\n\n".join(doc.page_content for doc in docs)
@@ -94,12 +81,108 @@ def create_qa_chain():
     chain = (
         {"context": retriever | format_docs, "question": RunnablePassthrough()}
         | prompt
-        | ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.7)
+        | ChatGoogleGenerativeAI(model=QA_CHAT_MODEL, temperature=0.7)
         | StrOutputParser()
     )
 
     return chain
 
+# --- QA Service ---
+class QANotConfiguredError(RuntimeError):
+    """Raised when the QA endpoint is used without Elastic credentials."""
+
+class QAService:
+    """Long-lived owner of the QA chain, its vector store and pooled connections.
+
+    Everything is built lazily on first use and reused across requests; the
+    service rebuilds only when the Elastic settings or model names change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._es_client = None
+        self._vector_store = None
+        self._chain = None
+
+    def _current_signature(self) -> tuple:
+        return _elastic_settings() + (elastic_index_name, QA_EMBEDDING_MODEL, QA_CHAT_MODEL, QA_TOP_K)
+
+    def _create_es_client(self):
+        api_key, cloud_id, endpoint_url = _elastic_settings()
+        pool_args = {"api_key": api_key, "connections_per_node": QA_CONNECTIONS_PER_NODE, "request_timeout": 30}
+        if endpoint_url:
+            return Elasticsearch(endpoint_url, **pool_args)
+        return Elasticsearch(cloud_id=cloud_id, **pool_args)
+
+    def _ensure(self):
+        signature = self._current_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            old_client = self._es_client
+            api_key, cloud_id, endpoint_url = _elastic_settings()
+            if not api_key or (not cloud_id and not endpoint_url):
+                self._es_client = self._vector_store = self._chain = None
+            else:
+                print("Building QA service...")
+                self._es_client = self._create_es_client()
+                self._vector_store = create_vector_store(es_connection=self._es_client)
+                self._chain = create_qa_chain(self._vector_store)
+            self._signature = signature
+            if old_client is not None:
+                old_client.close()
+
+    @property
+    def configured(self) -> bool:
+        self._ensure()
+        return self._chain is not None
+
+    def vector_store(self):
+        self._ensure()
+        return self._vector_store
+
+    def es_client(self):
+        self._ensure()
+        return self._es_client
+
+    def chain(self):
+        self._ensure()
+        if self._chain is None:
+            raise QANotConfiguredError("Elasticsearch credentials not configured.")
+        return self._chain
+
+    def invoke(self, question: str) -> str:
+        return self.chain().invoke(question)
+
+    async def ainvoke(self, question: str) -> str:
+        # Building the chain constructs sync SDK clients, so a (re)build runs off the event loop
+        if self._signature != self._current_signature():
+            await executor.run("default", self._ensure)
+        with metrics.span("qa_chain"):
+            return await self.chain().ainvoke(question)
+
+    def warmup(self):
+        """Builds the chain and opens the Elastic connection pool ahead of the first request."""
+        if not self.configured:
+            print("Skipping QA warmup because Elastic credentials are not set.")
+            return
+        self._es_client.info()
+        print("QA service warmed up.")
+
+    async def awarmup(self):
+        try:
+            await executor.run("default", self.warmup)
+        except Exception as e:
+            print(f"QA warmup failed: {e}")
+
+service = QAService()
+
+def warmup():
+    service.warmup()
+
 if __name__ == "__main__":
     # This part is for testing purposes and will only run when the script is executed directly
     if not ELASTIC_API_KEY or (not ELASTIC_CLOUD_ID and not ELASTIC_ENDPOINT_URL):
@@ -108,9 +191,8 @@ if __name__ == "__main__":
         print("Loading and indexing documents...")
         load_and_index_docs()
         print("Documents indexed.")
-        qa_chain = create_qa_chain()
         question = "what is our sales goals?"
         print(f"Asking: {question}")
-        answer = qa_chain.invoke(question)
+        answer = service.invoke(question)
         print(f"Answer: {answer}")
 
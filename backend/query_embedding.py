@@ -0,0 +1,70 @@
+"""
+Sentence embeddings of visitor questions, for matching paraphrases.
+
+The semantic response cache and the answer pack reuse an answer only for a
+question that means the same thing. The hashed word features used for
+retrieval cannot tell that (they drop "who"/"where" as stopwords and score
+real paraphrases low), so questions are compared with a small local
+sentence-transformer instead. The model loads as the `query_embedding`
+subsystem; until it is ready, or if sentence-transformers is not installed,
+`aembed()` returns None and callers fall back to exact matches of the
+normalized question.
+"""
+import os
+import re
+import threading
+
+import numpy as np
+
+from . import executor
+from . import subsystems
+
+# --- Configuration ---
+QUERY_EMBEDDING_MODEL = os.environ.get("QUERY_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+# Two questions about the same subject but with different question words ask different things
+QUESTION_WORDS = frozenset("who whom whose what which where when why how".split())
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+model = None
+_model_lock = threading.Lock()
+
+
+def load_model():
+    """Loads the sentence-transformer once; the `query_embedding` subsystem's warm-up."""
+    global model
+    if model is not None:
+        return model
+    with _model_lock:
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            loaded = SentenceTransformer(QUERY_EMBEDDING_MODEL, device="cpu")
+            loaded.encode(["warm up"])
+            model = loaded
+    return model
+
+
+def embed(text: str) -> np.ndarray:
+    """Unit-length embedding of `text` (blocking; loads the model if needed)."""
+    return load_model().encode([text], normalize_embeddings=True)[0].astype(np.float32)
+
+
+def embed_many(texts: list) -> np.ndarray:
+    return load_model().encode(list(texts), normalize_embeddings=True).astype(np.float32)
+
+
+async def aembed(text: str):
+    """The embedding, or None while the model is not loaded; never waits for the load."""
+    if not subsystems.get("query_embedding").loaded:
+        return None
+    return await executor.run("default", embed, text)
+
+
+def question_words(text: str) -> frozenset:
+    return frozenset(word for word in _WORD_RE.findall(text.lower()) if word in QUESTION_WORDS)
+
+
+def same_question(a: str, b: str, embedding_a: np.ndarray, embedding_b: np.ndarray, threshold: float) -> bool:
+    """True when two questions ask the same thing: same question words and close embeddings."""
+    return question_words(a) == question_words(b) and float(embedding_a @ embedding_b) >= threshold
@@ -0,0 +1,184 @@
+"""
+Semantic cache of complete dual-persona responses for the /ws pipeline.
+
+Visitors ask the same few questions in many phrasings. A turn is cached
+under its normalized question, its sentence embedding (see query_embedding)
+and a fingerprint of the retrieved context. A new query with the same
+context replays the recorded Papito text and Mateo audio instead of calling
+Gemini again when it is the same question after normalization, or when it
+uses the same question words and its embedding is within the cosine
+threshold. Without the embedding model only exact questions match.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from . import query_embedding
+from . import singleflight
+
+# --- Configuration ---
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "1") not in ("0", "false", "False")
+# Cosine similarity of the sentence embeddings; the retrieved context must also match.
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.8))
+SEMANTIC_CACHE_TTL_S = float(os.environ.get("SEMANTIC_CACHE_TTL_S", 6 * 3600))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 2000))
+SEMANTIC_CACHE_MAX_BYTES = int(os.environ.get("SEMANTIC_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# 1.0 replays audio at playback speed; 0 sends it as fast as the socket allows.
+SEMANTIC_CACHE_REPLAY_SPEED = float(os.environ.get("SEMANTIC_CACHE_REPLAY_SPEED", 1.0))
+
+AUDIO_BYTES_PER_SECOND = 24000 * 2  # Mateo's Live audio: 24 kHz, 16-bit mono PCM
+
+def context_fingerprint(context: list) -> str:
+    digest = hashlib.sha1()
+    for passage in context:
+        digest.update(passage.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    query: str
+    key: str  # singleflight.make_key of the query
+    embedding: np.ndarray  # None when stored before the embedding model was ready
+    fingerprint: str
+    messages: list  # [("text", str) | ("bytes", bytes)] in the order they were sent
+    created: float = field(default_factory=time.monotonic)
+
+    @property
+    def size(self) -> int:
+        return sum(len(payload) for _, payload in self.messages)
+
+
+class ResponseRecorder:
+    """Wraps a websocket, forwarding every frame and keeping a copy for the cache."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.messages = []
+        self.failed = False
+
+    async def send_text(self, data: str):
+        self.messages.append(("text", data))
+        if json.loads(data).get("type") == "error":
+            self.failed = True
+        await self.websocket.send_text(data)
+
+    async def send_bytes(self, data: bytes):
+        self.messages.append(("bytes", bytes(data)))
+        await self.websocket.send_bytes(data)
+
+
+class SemanticResponseCache:
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL_S,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, max_bytes: int = SEMANTIC_CACHE_MAX_BYTES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # id -> CachedResponse, least recently used first
+        self._by_fingerprint = {}  # fingerprint -> set of ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        self.size -= entry.size
+        ids = self._by_fingerprint[entry.fingerprint]
+        ids.discard(entry_id)
+        if not ids:
+            del self._by_fingerprint[entry.fingerprint]
+
+    def _matches(self, entry: CachedResponse, query: str, key: str, embedding) -> float:
+        """1.0 for the same normalized question, else the cosine of a qualifying paraphrase, else 0."""
+        if entry.key == key:
+            return 1.0
+        if embedding is None or entry.embedding is None:
+            return 0.0
+        if not query_embedding.same_question(query, entry.query, embedding, entry.embedding, self.threshold):
+            return 0.0
+        return float(entry.embedding @ embedding)
+
+    def lookup(self, query: str, context: list, embedding: np.ndarray = None):
+        """Returns the best cached response for the same context, or None.
+
+        `embedding` is the query's `query_embedding` vector; without it only
+        the same normalized question matches.
+        """
+        key = singleflight.make_key(query)
+        fingerprint = context_fingerprint(context)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_fingerprint.get(fingerprint, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = self._matches(entry, query, key, embedding)
+                if score > 0 and score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.counters["hits"] += 1
+            return self._entries[best_id]
+
+    def store(self, query: str, context: list, messages: list, embedding: np.ndarray = None):
+        entry = CachedResponse(query, singleflight.make_key(query), embedding, context_fingerprint(context), messages)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            self._by_fingerprint.setdefault(entry.fingerprint, set()).add(entry_id)
+            self.size += entry.size
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.size,
+        }
+
+
+async def replay(websocket, entry: CachedResponse, speed: float = SEMANTIC_CACHE_REPLAY_SPEED):
+    """Re-sends a cached turn."""
+    await replay_messages(websocket, entry.messages, speed)
+
+
+async def replay_messages(websocket, messages: list, speed: float = SEMANTIC_CACHE_REPLAY_SPEED):
+    """Sends recorded frames; audio is paced like a live stream, text goes out immediately."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    audio_seconds = 0.0
+    for kind, payload in messages:
+        if kind == "text":
+            await websocket.send_text(payload)
+            continue
+        if speed > 0:
+            delay = start + audio_seconds / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await websocket.send_bytes(payload)
+        audio_seconds += len(payload) / AUDIO_BYTES_PER_SECOND
+
+
+cache = SemanticResponseCache()
@@ -0,0 +1,291 @@
+"""
+In-process retrieval for TerraTale.
+
+A hybrid engine over the local corpus files: a BM25 inverted index for exact
+terms (species and place names) plus a dense NumPy matrix for fuzzier
+matches. Both are built once at startup, or loaded from a prebuilt artifact,
+so a lookup is a handful of array operations with no network round trip.
+Elasticsearch remains available behind the same interface.
+"""
+import json
+import math
+import os
+import re
+import threading
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+
+from . import executor
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(__file__)
+DEFAULT_CORPUS = [os.path.join(BASE_DIR, "knowledge.json"), os.path.join(BASE_DIR, "data.json")]
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "local")
+RETRIEVAL_CORPUS = [p for p in os.environ.get("RETRIEVAL_CORPUS", "").split(",") if p] or DEFAULT_CORPUS
+RETRIEVAL_INDEX_PATH = os.environ.get("RETRIEVAL_INDEX_PATH", os.path.join(BASE_DIR, "retrieval_index.npz"))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 4))
+# Weight of the BM25 score in the hybrid blend; the dense score gets the rest.
+RETRIEVAL_BM25_WEIGHT = float(os.environ.get("RETRIEVAL_BM25_WEIGHT", 0.6))
+
+EMBEDDING_DIM = 512
+PASSAGE_MAX_WORDS = 120
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset(
+    "a an and are as at be by do does for from how in is it of on or that the their this to was what when where which who why with".split()
+)
+
+
+@dataclass
+class Passage:
+    text: str
+    source: str
+    score: float = 0.0
+
+
+def tokenize(text: str) -> list:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+# --- Corpus Loading ---
+def _split_passages(content: str) -> list:
+    """Splits a document on blank lines, merging short paragraphs up to PASSAGE_MAX_WORDS."""
+    passages, current, words = [], [], 0
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        n = len(paragraph.split())
+        if current and words + n > PASSAGE_MAX_WORDS:
+            passages.append("\n".join(current))
+            current, words = [], 0
+        current.append(paragraph)
+        words += n
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+def load_corpus(paths: list = None) -> list:
+    """Reads JSON corpus files (lists of {"name", "content"}) into passages."""
+    passages = []
+    for path in paths or RETRIEVAL_CORPUS:
+        with open(path, "r") as f:
+            docs = json.load(f)
+        for doc in docs:
+            for text in _split_passages(doc["content"]):
+                passages.append(Passage(text=text, source=doc.get("name", os.path.basename(path))))
+    return passages
+
+
+# --- Dense Embeddings ---
+class HashingEmbedder:
+    """Local dense embeddings from hashed word and character-trigram features.
+
+    Deterministic and dependency-free, so the same vectors can be rebuilt at
+    startup or shipped in the prebuilt artifact.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def _features(self, tokens: list):
+        for token in tokens:
+            yield token, 1.0
+            padded = f"#{token}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self._features(tokenize(text)):
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % self.dim] += weight if (h >> 31) & 1 else -weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_many(self, texts: list) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self.embed(text) for text in texts])
+
+
+# --- Local Engine ---
+class LocalRetriever:
+    """BM25 + dense hybrid search over an in-memory corpus."""
+
+    def __init__(self, passages: list, vectors: np.ndarray, postings: dict, doc_lengths: np.ndarray, embedder=None):
+        self.passages = passages
+        self.vectors = vectors
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+        self.avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        self.embedder = embedder or HashingEmbedder(vectors.shape[1] if vectors.ndim == 2 else EMBEDDING_DIM)
+
+    @classmethod
+    def build(cls, passages: list, embedder=None) -> "LocalRetriever":
+        embedder = embedder or HashingEmbedder()
+        term_docs = {}
+        doc_lengths = np.zeros(len(passages), dtype=np.float32)
+        for doc_id, passage in enumerate(passages):
+            tokens = tokenize(passage.text)
+            doc_lengths[doc_id] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                term_docs.setdefault(token, []).append((doc_id, tf))
+
+        n = len(passages)
+        postings = {}
+        for term, entries in term_docs.items():
+            df = len(entries)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            doc_ids = np.fromiter((d for d, _ in entries), dtype=np.int32, count=df)
+            tfs = np.fromiter((tf for _, tf in entries), dtype=np.float32, count=df)
+            postings[term] = (idf, doc_ids, tfs)
+
+        vectors = embedder.embed_many([p.text for p in passages])
+        return cls(passages, vectors, postings, doc_lengths, embedder)
+
+    # --- Persistence ---
+    def save(self, path: str):
+        terms = sorted(self.postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            offsets[i + 1] = offsets[i] + len(self.postings[term][1])
+        np.savez(
+            path,
+            vectors=self.vectors,
+            doc_lengths=self.doc_lengths,
+            terms=np.array(json.dumps(terms)),
+            idf=np.array([self.postings[t][0] for t in terms], dtype=np.float32),
+            offsets=offsets,
+            doc_ids=np.concatenate([self.postings[t][1] for t in terms]) if terms else np.zeros(0, np.int32),
+            tfs=np.concatenate([self.postings[t][2] for t in terms]) if terms else np.zeros(0, np.float32),
+            passages=np.array(json.dumps([[p.text, p.source] for p in self.passages])),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LocalRetriever":
+        with np.load(path) as data:
+            terms = json.loads(str(data["terms"]))
+            idf, offsets, doc_ids, tfs = data["idf"], data["offsets"], data["doc_ids"], data["tfs"]
+            postings = {
+                term: (float(idf[i]), doc_ids[offsets[i]:offsets[i + 1]], tfs[offsets[i]:offsets[i + 1]])
+                for i, term in enumerate(terms)
+            }
+            passages = [Passage(text=t, source=s) for t, s in json.loads(str(data["passages"]))]
+            return cls(passages, data["vectors"], postings, data["doc_lengths"])
+
+    # --- Search ---
+    def _bm25(self, tokens: list) -> np.ndarray:
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        for token in set(tokens):
+            entry = self.postings.get(token)
+            if entry is None:
+                continue
+            idf, doc_ids, tfs = entry
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_ids] / self.avg_length)
+            scores[doc_ids] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        return scores
+
+    def search(self, query: str, k: int = RETRIEVAL_TOP_K) -> list:
+        if not self.passages:
+            return []
+        bm25 = self._bm25(tokenize(query))
+        dense = self.vectors @ self.embedder.embed(query)
+
+        # Scale BM25 into [0, 1] so it blends with cosine similarity
+        top = bm25.max()
+        if top > 0:
+            bm25 = bm25 / top
+        scores = RETRIEVAL_BM25_WEIGHT * bm25 + (1 - RETRIEVAL_BM25_WEIGHT) * np.maximum(dense, 0)
+
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            Passage(text=self.passages[i].text, source=self.passages[i].source, score=float(scores[i]))
+            for i in best
+            if scores[i] > 0
+        ]
+
+    async def asearch(self, query: str, k: int = RETRIEVAL_TOP_K) -> list:
+        return self.search(query, k)
+
+
+# --- Elasticsearch Backend ---
+class ElasticsearchRetriever:
+    """The Elasticsearch vector store used by qa_system, behind the retriever interface."""
+
+    def __init__(self):
+        from . import qa_system
+        self.store = qa_system.service.vector_store()
+        if self.store is None:
+            raise ConnectionError("Elasticsearch credentials not configured.")
+
+    def search(self, query: str, k: int = RETRIEVAL_TOP_K) -> list:
+        return [
+            Passage(text=doc.page_content, source=doc.metadata.get("name", ""), score=float(score))
+            for doc, score in self.store.similarity_search_with_score(query, k=k)
+        ]
+
+    async def asearch(self, query: str, k: int = RETRIEVAL_TOP_K) -> list:
+        return await executor.run("default", self.search, query, k)
+
+
+# --- Engine Access ---
+_retriever = None
+_retriever_lock = threading.Lock()
+
+
+def _artifact_is_fresh(path: str, corpus: list) -> bool:
+    if not os.path.exists(path):
+        return False
+    built = os.path.getmtime(path)
+    return all(os.path.getmtime(p) <= built for p in corpus if os.path.exists(p))
+
+
+def build_local_retriever() -> LocalRetriever:
+    """Loads the prebuilt artifact if it is up to date, otherwise indexes the corpus."""
+    if _artifact_is_fresh(RETRIEVAL_INDEX_PATH, RETRIEVAL_CORPUS):
+        print(f"Loading retrieval index from {RETRIEVAL_INDEX_PATH}")
+        return LocalRetriever.load(RETRIEVAL_INDEX_PATH)
+    passages = load_corpus(RETRIEVAL_CORPUS)
+    print(f"Built retrieval index over {len(passages)} passages.")
+    return LocalRetriever.build(passages)
+
+
+def get_retriever():
+    """Returns the process-wide retriever, building it on first use."""
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                if RETRIEVAL_BACKEND == "elasticsearch":
+                    _retriever = ElasticsearchRetriever()
+                else:
+                    _retriever = build_local_retriever()
+    return _retriever
+
+
+if __name__ == "__main__":
+    # Prebuild the on-disk artifact: python -m backend.retrieval [query]
+    import sys
+    import time
+
+    engine = LocalRetriever.build(load_corpus(RETRIEVAL_CORPUS))
+    engine.save(RETRIEVAL_INDEX_PATH)
+    print(f"Wrote {len(engine.passages)} passages to {RETRIEVAL_INDEX_PATH}")
+    if len(sys.argv) > 1:
+        query = " ".join(sys.argv[1:])
+        start = time.perf_counter()
+        results = engine.search(query)
+        print(f"Search took {(time.perf_counter() - start) * 1e6:.0f} us")
+        for passage in results:
+            print(f"{passage.score:.3f} [{passage.source}] {passage.text[:100]}")
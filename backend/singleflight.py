@@ -0,0 +1,143 @@
+"""
+Single-flight deduplication of identical in-flight upstream requests.
+
+When a tour group asks the same question at once, the first request starts
+the upstream call and everyone else subscribes to it. Streams are buffered,
+so a latecomer first receives the prefix produced so far and then follows
+live. The upstream call is cancelled only when its last subscriber leaves.
+"""
+import asyncio
+import hashlib
+import re
+
+_PUNCTUATION_RE = re.compile(r"[\s?!.,;:]+$")
+
+
+def normalize_query(text: str) -> str:
+    """Case, whitespace and trailing punctuation do not change the answer."""
+    return _PUNCTUATION_RE.sub("", re.sub(r"\s+", " ", text).strip().lower())
+
+
+def make_key(query: str, *parts) -> str:
+    digest = hashlib.sha1(normalize_query(query).encode("utf-8"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(str(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Broadcast:
+    """A replayable stream: every subscriber sees every item from the start."""
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.producer = None
+        self._changed = asyncio.Condition()
+
+    async def publish(self, item):
+        async with self._changed:
+            self.items.append(item)
+            self._changed.notify_all()
+
+    async def finish(self, error: BaseException = None):
+        async with self._changed:
+            self.done, self.error = True, error
+            self._changed.notify_all()
+
+    async def subscribe(self):
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: position < len(self.items) or self.done)
+                pending = self.items[position:]
+                finished, error = self.done, self.error
+            for item in pending:
+                yield item
+            position += len(pending)
+            if finished and position >= len(self.items):
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._streams = {}
+        self._calls = {}
+        self._waiters = {}
+        self.counters = {"leaders": 0, "followers": 0}
+
+    # --- Streams ---
+    async def _produce(self, key: str, broadcast: Broadcast, factory):
+        try:
+            async for item in factory():
+                await broadcast.publish(item)
+        except asyncio.CancelledError:
+            await broadcast.finish(ConnectionAbortedError(f"{self.name} upstream cancelled."))
+            raise
+        except Exception as e:
+            await broadcast.finish(e)
+        else:
+            await broadcast.finish()
+        finally:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+
+    async def stream(self, key: str, factory):
+        """Yields the items of `factory()`, sharing one upstream call per key."""
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.counters["leaders"] += 1
+            broadcast = self._streams[key] = Broadcast()
+            broadcast.producer = asyncio.create_task(self._produce(key, broadcast, factory))
+        else:
+            self.counters["followers"] += 1
+
+        broadcast.subscribers += 1
+        try:
+            async for item in broadcast.subscribe():
+                yield item
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                # Nobody is listening any more; stop paying for the upstream call
+                broadcast.producer.cancel()
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+
+    # --- Single results ---
+    async def do(self, key: str, factory):
+        """Awaits `factory()`, sharing one upstream call per key."""
+        task = self._calls.get(key)
+        if task is None:
+            self.counters["leaders"] += 1
+            task = self._calls[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.counters["followers"] += 1
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # Shielded so one caller's cancellation does not cancel everyone's result
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] == 0:
+                del self._waiters[task]
+                if not task.done():
+                    # Nobody is waiting any more; stop paying for the upstream call
+                    task.cancel()
+                    self._forget(key, task)
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if task.done() and not task.cancelled():
+            task.exception()  # Retrieved, so a result nobody waited for is not logged as lost
+
+    def stats(self) -> dict:
+        return {**self.counters, "in_flight": len(self._streams) + len(self._calls)}
@@ -0,0 +1,137 @@
+"""
+Lazily loaded subsystems and their readiness.
+
+Heavy features (langchain QA, CLIP image search) are imported on first use or
+by a background warmup task instead of at module load, so the app can serve
+chat traffic while they are still loading. `/readyz` reports each one.
+"""
+import asyncio
+import importlib
+import os
+import threading
+import time
+
+from . import executor
+
+# --- Configuration ---
+# Start serving immediately and warm subsystems in the background.
+FAST_START = os.environ.get("FAST_START", "1") not in ("0", "false", "False")
+WARMUP_SUBSYSTEMS = [s for s in os.environ.get("WARMUP_SUBSYSTEMS", "retrieval,query_embedding,qa,image_search").split(",") if s]
+
+NOT_LOADED, LOADING, READY, FAILED = "not_loaded", "loading", "ready", "failed"
+
+
+class Subsystem:
+    """A module plus an optional warm-up step, loaded at most once."""
+
+    def __init__(self, name: str, module: str, warmup: str = None, required: bool = False):
+        self.name = name
+        self.module_name = module
+        self.warmup_name = warmup
+        self.required = required
+        self.state = NOT_LOADED
+        self.error = None
+        self.load_seconds = None
+        self._module = None
+        self._lock = threading.Lock()
+        self._task = None  # The in-flight load every `aload` caller awaits
+
+    def load(self):
+        """Imports and warms the subsystem (blocking); returns the module."""
+        if self.state == READY:
+            return self._module
+        with self._lock:
+            if self.state == READY:
+                return self._module
+            self.state = LOADING
+            start = time.perf_counter()
+            try:
+                module = importlib.import_module(f"{__package__}.{self.module_name}")
+                if self.warmup_name:
+                    getattr(module, self.warmup_name)()
+            except Exception as e:
+                self.state, self.error = FAILED, str(e)
+                print(f"Subsystem '{self.name}' failed to load: {e}")
+                raise
+            self._module = module
+            self.load_seconds = time.perf_counter() - start
+            self.state, self.error = READY, None
+            print(f"Subsystem '{self.name}' ready in {self.load_seconds:.2f}s")
+            return module
+
+    async def aload(self):
+        """Loads the subsystem on its own thread pool so the event loop keeps serving.
+
+        Concurrent callers share one load instead of each parking a thread on the lock; a
+        failed load is retried by the next caller.
+        """
+        if self.state == READY:
+            return self._module
+        task = self._task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = self._task = asyncio.ensure_future(executor.run("subsystems", self.load))
+            # Mark the error retrieved even if every caller was cancelled; `load` already logged it
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # Shielded so one caller's cancellation does not abort everyone's load
+        return await asyncio.shield(task)
+
+    @property
+    def module(self):
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self.state == READY
+
+    def status(self) -> dict:
+        return {"state": self.state, "required": self.required, "load_seconds": self.load_seconds, "error": self.error}
+
+
+registry = {
+    subsystem.name: subsystem
+    for subsystem in (
+        Subsystem("retrieval", "retrieval", warmup="get_retriever", required=True),
+        Subsystem("query_embedding", "query_embedding", warmup="load_model"),
+        Subsystem("qa", "qa_system", warmup="warmup"),
+        Subsystem("image_search", "image_search", warmup="load_model"),
+    )
+}
+
+
+def get(name: str) -> Subsystem:
+    return registry[name]
+
+
+async def aload(name: str):
+    return await registry[name].aload()
+
+
+async def warmup(names: list = None):
+    """Loads the given subsystems one after another, logging rather than raising failures."""
+    for name in names or WARMUP_SUBSYSTEMS:
+        if name not in registry:
+            print(f"Unknown subsystem in WARMUP_SUBSYSTEMS: {name}")
+            continue
+        try:
+            await registry[name].aload()
+        except Exception:
+            pass
+
+
+_warmup_task = None
+
+
+async def start():
+    """Called from startup: warm in the background in fast-start mode, otherwise before serving."""
+    global _warmup_task
+    if FAST_START:
+        _warmup_task = asyncio.create_task(warmup())
+    else:
+        await warmup()
+
+
+def readiness() -> tuple:
+    """Returns (ready, per-subsystem status); only required subsystems gate readiness."""
+    statuses = {name: subsystem.status() for name, subsystem in registry.items()}
+    ready = all(subsystem.loaded for subsystem in registry.values() if subsystem.required)
+    return ready, statuses
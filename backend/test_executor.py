@@ -0,0 +1,39 @@
+# test_executor.py
+import asyncio
+import threading
+
+import pytest
+
+from backend.executor import BoundedPool, PoolSaturatedError
+
+
+def test_counters_track_running_and_queued_jobs():
+    async def scenario():
+        pool = BoundedPool("test", max_workers=1, max_queue=1)
+        started, release = threading.Event(), threading.Event()
+
+        def job():
+            started.set()
+            release.wait(5)
+            return "done"
+
+        first = asyncio.create_task(pool.run(job))
+        await asyncio.to_thread(started.wait, 5)
+        stats = pool.stats()
+        assert (stats["active"], stats["queue_depth"]) == (1, 0)
+
+        second = asyncio.create_task(pool.run(job))
+        await asyncio.sleep(0)
+        stats = pool.stats()
+        assert (stats["active"], stats["queue_depth"], stats["max_queue_depth"]) == (1, 1, 1)
+
+        with pytest.raises(PoolSaturatedError):
+            await pool.run(job)
+
+        release.set()
+        assert await asyncio.gather(first, second) == ["done", "done"]
+        stats = pool.stats()
+        assert (stats["active"], stats["queue_depth"], stats["completed"], stats["rejected"]) == (0, 0, 2, 1)
+        pool.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,167 @@
+"""
+Content-addressed cache for synthesized speech.
+
+Audio is keyed by a hash of everything that determines the bytes Google TTS
+returns (final SSML, voice, encoding), so identical "Read Aloud" requests are
+served from memory or disk instead of paying for another synthesis.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from . import executor
+
+# --- Configuration ---
+TTS_CACHE_MEMORY_BYTES = int(os.environ.get("TTS_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+TTS_CACHE_DISK_BYTES = int(os.environ.get("TTS_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".cache", "tts"))
+
+
+def make_key(ssml: str, voice: str, encoding: str) -> str:
+    digest = hashlib.sha256()
+    for part in (ssml, voice, encoding):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class MemoryLRU:
+    """An LRU of bytes values bounded by their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DiskCache:
+    """A directory of audio files bounded by total size, evicting least recently used first."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self):
+        # Built lazily so startup never walks the cache directory
+        if self._sizes is None:
+            sizes = {}
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not name.endswith(".tmp"):
+                        sizes[name] = os.path.getsize(os.path.join(root, name))
+            self._sizes = sizes
+        return self._sizes
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # Touch for LRU ordering
+        except FileNotFoundError:
+            pass  # Evicted by another thread since the read; the bytes are still good
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            sizes = self._scan()
+            sizes[key] = len(data)
+            self._evict(sizes)
+
+    def _evict(self, sizes: dict):
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+        by_age = sorted(sizes, key=lambda k: self._mtime(k))
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= sizes.pop(key)
+
+    def _mtime(self, key: str) -> float:
+        try:
+            return os.path.getmtime(self._path(key))
+        except FileNotFoundError:
+            return 0.0
+
+
+class TTSCache:
+    """Two-tier (memory, then disk) cache for synthesized audio."""
+
+    def __init__(self, memory_bytes: int = TTS_CACHE_MEMORY_BYTES, disk_bytes: int = TTS_CACHE_DISK_BYTES, directory: str = TTS_CACHE_DIR):
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskCache(directory, disk_bytes) if disk_bytes > 0 else None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    async def get(self, key: str):
+        data = self.memory.get(key)
+        if data is not None:
+            self.counters["memory_hits"] += 1
+            return data
+        if self.disk is not None:
+            data = await executor.run("default", self.disk.get, key)
+            if data is not None:
+                self.counters["disk_hits"] += 1
+                self.memory.put(key, data)
+                return data
+        self.counters["misses"] += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        self.memory.put(key, data)
+        if self.disk is not None:
+            try:
+                await executor.run("default", self.disk.put, key, data)
+            except OSError as e:
+                print(f"Could not write TTS cache entry: {e}")
+
+    def stats(self) -> dict:
+        return {**self.counters, "memory_entries": len(self.memory), "memory_bytes": self.memory.size}
+
+
+cache = TTSCache()
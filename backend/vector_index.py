@@ -0,0 +1,254 @@
+"""
+Local, memory-mapped vector index for CLIP image embeddings.
+
+On disk an index is a directory of plain .npy arrays:
+
+    vectors.npy        (n, dim) float16, or int8 with a per-row scale in scales.npy
+    meta_blob.npy      UTF-8 JSON rows [photo_id, url, description, label], concatenated
+    meta_offsets.npy   (n + 1,) int64 byte offsets into meta_blob
+    ivf_*.npy          optional inverted-file lists (centroids + contiguous row ranges)
+    info.json          dim, count, dtype, nlist and the generation directory holding the arrays
+
+The arrays of each build go into a fresh generation directory, and info.json
+is replaced atomically last, so a rebuild never touches files a running
+server has mapped and a reader never mixes arrays from two builds.
+
+Everything is opened with mmap, so opening is instant, the OS page cache is
+shared by every worker process, and only the rows a query touches are paged in.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+# --- Configuration ---
+IMAGE_INDEX_DIR = os.environ.get("IMAGE_INDEX_DIR", "data/unsplash/local_index")
+# int8 (default) scans fastest on CPU; float16 keeps more precision at 2x the size.
+IMAGE_INDEX_DTYPE = os.environ.get("IMAGE_INDEX_DTYPE", "int8")
+# Build an IVF (approximate) layer once the index has at least this many rows.
+IVF_MIN_ROWS = int(os.environ.get("IMAGE_INDEX_IVF_MIN_ROWS", 50000))
+IVF_NPROBE = int(os.environ.get("IMAGE_INDEX_NPROBE", 8))
+SCAN_BLOCK_ROWS = 1024  # Keeps each converted block in cache
+STAGING_DIR = "staging"
+STAGING_SYNC_ROWS = 256  # Staged rows are fsynced (and reported done) in batches of this size
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _kmeans(vectors: np.ndarray, nlist: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample; returns normalized centroids."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(len(vectors), nlist * 256), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assignment == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+def _top_k(scores: np.ndarray, k: int):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+# --- Building ---
+class LocalIndexWriter:
+    """Stages embeddings as they are produced, then writes the final index.
+
+    Staging is append-only, so an indexing run interrupted part way resumes
+    by appending more rows before `finalize()`.
+    """
+
+    def __init__(self, directory: str = IMAGE_INDEX_DIR, dim: int = 512):
+        self.directory = directory
+        self.dim = dim
+        self.staging = os.path.join(directory, STAGING_DIR)
+        os.makedirs(self.staging, exist_ok=True)
+
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(self.staging, "checkpoint.sqlite")
+
+    def write(self, documents):
+        """Pipeline sink: stages each document and yields (photo_id, ok, error)."""
+        vectors_path = os.path.join(self.staging, "vectors.f32")
+        meta_path = os.path.join(self.staging, "meta.jsonl")
+        with open(vectors_path, "ab") as vectors_file, open(meta_path, "a", encoding="utf-8") as meta_file:
+            def sync():
+                for f in (vectors_file, meta_file):
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # Successes are reported only once durable, since the caller checkpoints them as done
+            written = []
+            for doc in documents:
+                vector = normalize(doc["image_embedding"]).reshape(-1)
+                if vector.shape[0] != self.dim:
+                    yield doc["photo_id"], False, f"expected {self.dim} dims, got {vector.shape[0]}"
+                    continue
+                vectors_file.write(vector.tobytes())
+                meta_file.write(json.dumps([doc["photo_id"], doc["photo_image_url"], doc["photo_description"], doc["label"]]) + "\n")
+                written.append(doc["photo_id"])
+                if len(written) >= STAGING_SYNC_ROWS:
+                    sync()
+                    yield from ((photo_id, True, None) for photo_id in written)
+                    written = []
+            sync()
+            yield from ((photo_id, True, None) for photo_id in written)
+
+    def finalize(self, dtype: str = IMAGE_INDEX_DTYPE, nlist: int = None):
+        """Deduplicates staged rows and writes the memory-mappable index files."""
+        raw = np.fromfile(os.path.join(self.staging, "vectors.f32"), dtype=np.float32).reshape(-1, self.dim)
+        with open(os.path.join(self.staging, "meta.jsonl"), encoding="utf-8") as f:
+            meta = [json.loads(line) for line in f]
+        rows = min(len(raw), len(meta))  # A crash can leave a torn final row
+
+        # Keep the last copy of each photo
+        latest = {}
+        for i in range(rows):
+            latest[meta[i][0]] = i
+        keep = np.array(sorted(latest.values()), dtype=np.int64)
+        vectors, meta = raw[keep], [meta[i] for i in keep]
+
+        if nlist is None:
+            nlist = int(np.sqrt(len(vectors))) if len(vectors) >= IVF_MIN_ROWS else 0
+        previous = _read_info(self.directory).get("generation")
+        generation = f"gen-{time.time_ns()}"
+        out = os.path.join(self.directory, generation)
+        os.makedirs(out)
+        info = {"dim": self.dim, "count": len(vectors), "dtype": dtype, "nlist": nlist, "generation": generation}
+
+        if nlist:
+            # Reorder rows so every inverted list is one contiguous slice
+            centroids = _kmeans(vectors, nlist)
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            vectors, meta = vectors[order], [meta[i] for i in order]
+            offsets = np.searchsorted(assignment[order], np.arange(nlist + 1))
+            np.save(os.path.join(out, "ivf_centroids.npy"), centroids.astype(np.float32))
+            np.save(os.path.join(out, "ivf_offsets.npy"), offsets.astype(np.int64))
+
+        if dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            np.save(os.path.join(out, "scales.npy"), scales.astype(np.float32))
+            stored = np.round(vectors / scales[:, None]).astype(np.int8)
+        else:
+            stored = vectors.astype(np.float16)
+        np.save(os.path.join(out, "vectors.npy"), stored)
+
+        encoded = [json.dumps(row).encode("utf-8") for row in meta]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in encoded], out=offsets[1:])
+        np.save(os.path.join(out, "meta_blob.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(out, "meta_offsets.npy"), offsets)
+
+        info_path = os.path.join(self.directory, "info.json")
+        with open(info_path + ".tmp", "w") as f:
+            json.dump(info, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(info_path + ".tmp", info_path)
+        self._remove_old_generations(keep={generation, previous})
+        print(f"Wrote local image index: {info}")
+        return info
+
+    def _remove_old_generations(self, keep: set):
+        # The previous build stays for readers that read info.json just before the swap;
+        # servers that already mapped older files keep them alive until they unmap
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("gen-") and name not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(".npy") and None not in keep:
+                os.remove(path)  # Arrays of an index written before generations existed
+
+
+def _read_info(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, "info.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# --- Searching ---
+class LocalVectorIndex:
+    def __init__(self, directory: str = IMAGE_INDEX_DIR):
+        with open(os.path.join(directory, "info.json")) as f:
+            self.info = json.load(f)
+        # Indexes written before generations existed keep their arrays next to info.json
+        arrays = os.path.join(directory, self.info.get("generation", ""))
+        load = lambda name: np.load(os.path.join(arrays, name), mmap_mode="r")
+        self.vectors = load("vectors.npy")
+        self.scales = load("scales.npy") if self.info["dtype"] == "int8" else None
+        self.meta_blob = load("meta_blob.npy")
+        self.meta_offsets = load("meta_offsets.npy")
+        self.centroids = np.asarray(load("ivf_centroids.npy")) if self.info["nlist"] else None
+        self.list_offsets = np.asarray(load("ivf_offsets.npy")) if self.info["nlist"] else None
+
+    def __len__(self):
+        return self.info["count"]
+
+    def _scores(self, start: int, stop: int, query: np.ndarray) -> np.ndarray:
+        scores = np.empty(stop - start, dtype=np.float32)
+        for block in range(start, stop, SCAN_BLOCK_ROWS):
+            end = min(block + SCAN_BLOCK_ROWS, stop)
+            chunk = self.vectors[block:end].astype(np.float32) @ query
+            if self.scales is not None:
+                chunk *= self.scales[block:end]
+            scores[block - start:end - start] = chunk
+        return scores
+
+    def search(self, query_vector, k: int = 5, exact: bool = None, nprobe: int = IVF_NPROBE) -> list:
+        """Returns [(row, cosine score)]; exact unless an IVF layer exists and exact is not requested."""
+        query = normalize(query_vector).reshape(-1)
+        if exact is None:
+            exact = self.centroids is None
+        if exact or self.centroids is None:
+            scores = self._scores(0, len(self), query)
+            best = _top_k(scores, k)
+            return [(int(i), float(scores[i])) for i in best]
+
+        candidates_rows, candidates_scores = [], []
+        for cluster in _top_k(self.centroids @ query, nprobe):
+            start, stop = int(self.list_offsets[cluster]), int(self.list_offsets[cluster + 1])
+            if stop > start:
+                candidates_rows.append(np.arange(start, stop))
+                candidates_scores.append(self._scores(start, stop, query))
+        if not candidates_rows:
+            return []
+        rows, scores = np.concatenate(candidates_rows), np.concatenate(candidates_scores)
+        best = _top_k(scores, k)
+        return [(int(rows[i]), float(scores[i])) for i in best]
+
+    def metadata(self, row: int) -> dict:
+        raw = bytes(self.meta_blob[self.meta_offsets[row]:self.meta_offsets[row + 1]])
+        photo_id, url, description, label = json.loads(raw)
+        return {"photo_id": photo_id, "photo_image_url": url, "photo_description": description, "label": label}
+
+    def hits(self, query_vector, k: int = 5, **kwargs) -> list:
+        """Search results shaped like Elasticsearch hits, so callers need not care about the backend."""
+        results = []
+        for row, score in self.search(query_vector, k, **kwargs):
+            source = self.metadata(row)
+            results.append({"_id": source["photo_id"], "_score": score, "_source": source})
+        return results
+
+
+def index_exists(directory: str = IMAGE_INDEX_DIR) -> bool:
+    return os.path.exists(os.path.join(directory, "info.json"))
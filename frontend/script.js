@@ -14,35 +14,57 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- WebSocket Logic ---
     function connectWebSocket() {
         const wsProtocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
-        socket = new WebSocket(`${wsProtocol}${window.location.host}/ws`);
+        // Ask for Opus only where the browser can decode it (WebCodecs)
+        const codecs = 'AudioDecoder' in window ? 'opus,pcm' : 'pcm';
+        socket = new WebSocket(`${wsProtocol}${window.location.host}/ws?codecs=${codecs}`);
+        socket.binaryType = 'arraybuffer';
 
         socket.onopen = () => {
             statusText.textContent = 'Ask a question with your voice or text.';
             [recordBtn, sendBtn].forEach(btn => btn.disabled = false);
         };
 
-        socket.onmessage = (event) => {
-            if (event.data instanceof Blob) {
-                audioChunks.push(event.data);
+        // Papito (text) and Mateo (audio) stream concurrently; render whichever arrives first.
+        // Binary frames are always Mateo's audio, JSON messages carry a `persona` tag.
+        socket.onmessage = async (event) => {
+            if (event.data instanceof ArrayBuffer) {
+                receiveAudioFrame(event.data);
                 return;
             }
             try {
                 const message = JSON.parse(event.data);
                 switch (message.type) {
+                    case 'text_delta':
+                        // Streamed tokens: show Papito's answer as it is written
+                        textResponseArea.innerText += message.content;
+                        textResponseArea.style.display = 'block';
+                        break;
+                    case 'text_end':
                     case 'text':
                         textResponseArea.innerText = message.content;
                         textResponseArea.style.display = 'block';
                         readPapitoBtn.style.display = 'inline-block'; // Make button visible
                         readPapitoBtn.disabled = false;
                         break;
+                    case 'cancelled':
+                        // The previous answer was interrupted; drop its partial audio
+                        resetAudioFrames();
+                        break;
                     case 'image_search_results':
                         displayImages(message.content);
                         break;
-                    case 'audio_end':
-                        if (audioChunks.length > 0) prepareAudioForPlayback();
+                    case 'audio_end': {
+                        // Detach this turn's frames first; the next turn may start while Opus finishes decoding
+                        const frames = audioChunks;
+                        resetAudioFrames();
+                        if (opusDecoder && opusDecoder.state === 'configured') await opusDecoder.flush();
+                        if (frames.length > 0) prepareAudioForPlayback(frames);
                         break;
+                    }
                     case 'error':
-                        statusText.textContent = `Server error: ${message.content}`;
+                        // Errors are tagged with the persona they came from; the other may still arrive
+                        const who = message.persona === 'mateo' ? 'Mateo' : message.persona === 'papito' ? 'Papito' : 'Server';
+                        statusText.textContent = `${who} error: ${message.content}`;
                         break;
                 }
             } catch (e) { console.error("Failed to parse JSON:", e); }
@@ -105,10 +127,78 @@ document.addEventListener('DOMContentLoaded', () => {
         readPapitoBtn.disabled = false;
     };
 
-    // --- Mateo's Audio Playback ---
-    async function prepareAudioForPlayback() {
-        const rawAudioData = await (new Blob(audioChunks)).arrayBuffer();
+    // --- Mateo's Audio Frames ---
+    // Header: version u8 | codec u8 | duration ms u16 | sequence u32 (little-endian), then the payload
+    const FRAME_HEADER_BYTES = 8, CODEC_PCM16 = 0, CODEC_PCM16_HALF = 1, CODEC_OPUS = 2, SAMPLE_RATE = 24000;
+    let audioChunks = []; // Int16Array per frame, in sequence order; Opus frames fill in as they decode
+    let lastSequence = null;
+    let opusDecoder = null;
+    const opusSlots = new Map(); // chunk timestamp -> [frames array, index] awaiting decoded samples
+    let opusCounter = 0;
+
+    function resetAudioFrames() {
         audioChunks = [];
+        lastSequence = null;
+    }
+
+    function resample(samples, fromRate) {
+        if (fromRate === SAMPLE_RATE) return samples;
+        const out = new Int16Array(Math.round(samples.length * SAMPLE_RATE / fromRate));
+        const step = fromRate / SAMPLE_RATE;
+        for (let i = 0; i < out.length; i++) {
+            const pos = i * step, j = Math.floor(pos), frac = pos - j;
+            out[i] = samples[Math.min(j, samples.length - 1)] * (1 - frac) + samples[Math.min(j + 1, samples.length - 1)] * frac;
+        }
+        return out;
+    }
+
+    function getOpusDecoder() {
+        if (!opusDecoder || opusDecoder.state === 'closed') {
+            opusDecoder = new AudioDecoder({
+                output: (data) => {
+                    const floats = new Float32Array(data.numberOfFrames);
+                    data.copyTo(floats, { planeIndex: 0, format: 'f32-planar' });
+                    const samples = Int16Array.from(floats, v => Math.max(-1, Math.min(1, v)) * 0x7fff);
+                    const slot = opusSlots.get(data.timestamp);
+                    if (slot) {
+                        slot[0][slot[1]] = resample(samples, data.sampleRate);
+                        opusSlots.delete(data.timestamp);
+                    }
+                    data.close();
+                },
+                error: (e) => console.error('Opus decoding failed:', e),
+            });
+            opusDecoder.configure({ codec: 'opus', sampleRate: SAMPLE_RATE, numberOfChannels: 1 });
+        }
+        return opusDecoder;
+    }
+
+    function receiveAudioFrame(buffer) {
+        const header = new DataView(buffer, 0, FRAME_HEADER_BYTES);
+        const codec = header.getUint8(1), durationMs = header.getUint16(2, true), sequence = header.getUint32(4, true);
+        // Frames the server shed for a slow connection become silence, keeping the timing intact
+        if (lastSequence !== null && sequence > lastSequence + 1) {
+            const missing = sequence - lastSequence - 1;
+            for (let i = 0; i < missing; i++) audioChunks.push(new Int16Array(SAMPLE_RATE * durationMs / 1000));
+        }
+        lastSequence = sequence;
+
+        const payload = buffer.slice(FRAME_HEADER_BYTES);
+        if (codec === CODEC_OPUS) {
+            const timestamp = opusCounter++;
+            opusSlots.set(timestamp, [audioChunks, audioChunks.length]);
+            audioChunks.push(null);
+            getOpusDecoder().decode(new EncodedAudioChunk({ type: 'key', timestamp, data: payload }));
+        } else if (codec === CODEC_PCM16_HALF) {
+            audioChunks.push(resample(new Int16Array(payload), SAMPLE_RATE / 2));
+        } else {
+            audioChunks.push(new Int16Array(payload));
+        }
+    }
+
+    // --- Mateo's Audio Playback ---
+    async function prepareAudioForPlayback(frames) {
+        const rawAudioData = await (new Blob(frames.filter(frame => frame))).arrayBuffer();
         const waveFileBuffer = createWaveFile(rawAudioData);
         const audioBlob = new Blob([waveFileBuffer], { type: 'audio/wav' });
         const audioUrl = URL.createObjectURL(audioBlob);
@@ -146,7 +236,12 @@ document.addEventListener('DOMContentLoaded', () => {
         recordBtn.addEventListener('click', () => {
             recordBtn.classList.contains('recording') ? recognition.stop() : recognition.start();
         });
-        recognition.onstart = () => recordBtn.classList.add('recording');
+        recognition.onstart = () => {
+            recordBtn.classList.add('recording');
+            // Barge-in: stop Mateo as soon as the visitor starts speaking
+            mateoAudio.pause();
+            if (socket && socket.readyState === WebSocket.OPEN) socket.send(JSON.stringify({ type: 'cancel' }));
+        };
         recognition.onend = () => recordBtn.classList.remove('recording');
         recognition.onresult = (event) => sendQuery(event.results[0][0].transcript);
     }